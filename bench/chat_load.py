@@ -0,0 +1,155 @@
+"""Load-test chat dispatch against a local Twitch chat stand-in
+
+A ChatServer (bench/irc.py) runs in a separate process and floods the channel
+with a realistic mix of chat and !hack commands. ChatHack connects to it
+through an IrcChannel, and the frame loop runs on the stand-in cron, kept in
+step with the real clock. For each rate this reports what reached the
+reader, what was dispatched or dropped (and why), the latency from the
+server sending a command to its dispatch (with --vote, from the start of
+the vote window to its winners' dispatch), and the CPU spent per message on
+the reader thread and on the Talon thread.
+
+Run from the repository root:
+
+    python -m bench.chat_load --rates 10 1000 10000 --seconds 10
+    python -m bench.chat_load --rates 10000 --vote
+"""
+import argparse
+import multiprocessing
+import threading
+import time
+
+from . import standins
+from .irc import IrcChannel, serve
+from .replay import load_package, percentile
+
+# Seconds the server keeps running past the end of a run, so the reader is
+# stopped before the server closes the connection
+SERVER_MARGIN = 2.0
+
+class Run:
+    """The channel opened by ChatHack, dispatches, their latencies and vote windows, for one rate"""
+    def __init__(self, port: int):
+        self.port = port
+        self.channels = []
+        self.dispatched = 0
+        self.latencies = []
+        self.windows = 0
+        self.window_start = time.time()
+
+    def channel(self, name: str) -> IrcChannel:
+        channel = IrcChannel(name, self.port)
+        self.channels.append(channel)
+        return channel
+
+
+def thread_cpu(thread: threading.Thread) -> float:
+    return time.clock_gettime(time.pthread_getcpuclockid(thread.ident))
+
+
+def load(rate: float, seconds: float, seed: int, vote: bool):
+    from sm64 import chat
+    from sm64.chat import ChatHack
+    from sm64 import mapping
+
+    # Spawned rather than forked, as this process runs on the virtual clock
+    context = multiprocessing.get_context("spawn")
+    ports, results = context.Queue(), context.Queue()
+    server = context.Process(target=serve, args=(rate, seconds + SERVER_MARGIN, seed, ports, results))
+    server.start()
+    run = Run(ports.get())
+
+    # Every dispatch, queued or voted, goes through a command handler
+    commands = chat.manager.commands
+    def counted(handler):
+        def dispatch(label):
+            run.dispatched += 1
+            if vote:
+                run.latencies.append(time.time() - run.window_start)
+            handler(label)
+        return dispatch
+    chat.manager.commands = {keyword: counted(handler) for keyword, handler in commands.items()}
+
+    # Every queued command is dispatched through author_name, so its latency
+    # is taken there
+    author_name = chat.author_name
+    def timed_author_name(message):
+        run.latencies.append(time.time() - message.sent)
+        return author_name(message)
+    chat.author_name = timed_author_name
+    chat.Channel = run.channel
+
+    # Vote windows are ended through process_votes, as bound in mapping.py
+    process_votes = mapping.process_votes
+    def counted_process_votes():
+        run.windows += 1
+        process_votes()
+        run.window_start = time.time()
+    mapping.process_votes = counted_process_votes
+
+    user = standins.actions.user
+    if vote:
+        user.toggle_chat_voting()
+    user.toggle_chat_hack()
+    reader = ChatHack.reader
+
+    cpu_start = time.thread_time()
+    start = standins.real_perf_counter()
+    base = standins.VirtualClock.now
+    while (elapsed := standins.real_perf_counter() - start) < seconds:
+        standins.cron.advance_to(base + elapsed)
+        time.sleep(0.001)
+    loop_cpu = time.thread_time() - cpu_start
+    reader_cpu = thread_cpu(reader)
+
+    user.toggle_chat_hack()
+    if vote:
+        user.toggle_chat_voting()
+    ChatHack.close()
+    reader.join()
+    chat.author_name = author_name
+    chat.manager.commands = commands
+    mapping.process_votes = process_votes
+
+    server.join()
+    sent = results.get()
+    received = sum(channel.received for channel in run.channels)
+    dispatched = run.dispatched
+    latencies = [latency * 1000 for latency in run.latencies]
+
+    print(f"{rate:,.0f} msg/s for {seconds:.0f}s: sent {sent:,}, received {received:,}, dispatched {dispatched:,}")
+    if vote:
+        print(f"  vote windows: {run.windows:,}")
+    print("  dropped: " + ", ".join(f"{reason} {count:,}" for reason, count in ChatHack.drops.items()))
+    if latencies:
+        print(
+            f"  latency{' from window start' if vote else ''}: p50 {percentile(latencies, 50):.0f}ms  p99 {percentile(latencies, 99):.0f}ms  "
+            f"max {max(latencies):.0f}ms"
+        )
+    print(
+        f"  cpu: reader {reader_cpu / max(received, 1) * 1e6:.1f}us per message received, "
+        f"talon thread {loop_cpu * 1000:.0f}ms total"
+        + (f", {loop_cpu / dispatched * 1e6:.1f}us per dispatch" if dispatched else "")
+    )
+    if ChatHack.error is not None:
+        print(f"  reader failed: {ChatHack.error!r}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rates", type=float, nargs="+", default=[10, 1000, 10000], help="Messages per second")
+    parser.add_argument("--seconds", type=float, default=10, help="Length of each run, in real time")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--vote", action="store_true", help="Aggregate commands into votes")
+    args = parser.parse_args()
+
+    load_package()
+    for rate in args.rates:
+        load(rate, args.seconds, args.seed, args.vote)
+
+    if standins.errors:
+        print(f"errors: {len(standins.errors)}, first: {standins.errors[0]!r}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""A local stand-in for Twitch chat, over IRC
+
+ChatServer speaks enough of the Twitch IRC protocol (capabilities, login,
+JOIN, PING/PONG and tagged PRIVMSGs) for a chat client to connect, and
+floods every joined client with generated messages at a fixed rate.
+IrcChannel is a listen_to_twitch.Channel that connects to it.
+"""
+import itertools
+import random
+import select
+import socket
+import time
+
+from typing import Iterator, List, Tuple
+
+from .standins import Message
+
+HOST = "127.0.0.1"
+
+# Seconds between the server's keepalive PINGs
+PING_INTERVAL = 10.0
+
+# (weight, message). Most of chat is not commands, and commands are dominated
+# by a few favourites, sent in a mix of cases and with trailing words
+CHAT_MIX: List[Tuple[float, str]] = [
+    (30, "!hack jump"),
+    (8, "!hack punch"),
+    (6, "!hack run"),
+    (4, "!hack walk"),
+    (6, "!hack pulse left"),
+    (6, "!hack pulse right"),
+    (4, "!hack pulse up"),
+    (2, "!hack pulse down"),
+    (3, "!hack rotate left"),
+    (3, "!hack rotate right"),
+    (3, "!hack pound"),
+    (2, "!hack camera"),
+    (1, "!hack zoom in"),
+    (1, "!hack zoom out"),
+    (1, "!hack start"),
+    (4, "!HACK JUMP"),
+    (2, "!hack jump jump jump"),
+    (1, "!hack dance"),
+    (1, "!hackjump"),
+    (20, "LUL"),
+    (15, "Kappa"),
+    (10, "what is going on"),
+    (8, "mario pls"),
+    (6, "PogChamp PogChamp PogChamp"),
+    (4, "this is the best stream on twitch right now, no question about it"),
+]
+
+
+class MessageGenerator:
+    """Chat lines from CHAT_MIX, sent by a population of `authors`
+
+    Authors are drawn from a Zipf-like distribution, so a few of them send
+    most of the messages, as in a real chat.
+    """
+    def __init__(self, authors: int = 2000, seed: int = 0):
+        self.rng = random.Random(seed)
+        self.names = [f"viewer{i}" for i in range(authors)]
+        self.author_weights = list(itertools.accumulate(1 / (i + 1) for i in range(authors)))
+        self.texts = [text for _, text in CHAT_MIX]
+        self.text_weights = list(itertools.accumulate(weight for weight, _ in CHAT_MIX))
+        self.ids = itertools.count()
+
+    def lines(self, channel: str, count: int) -> bytes:
+        authors = self.rng.choices(self.names, cum_weights=self.author_weights, k=count)
+        texts = self.rng.choices(self.texts, cum_weights=self.text_weights, k=count)
+        sent = int(time.time() * 1000)
+        return b"".join(
+            (
+                f"@badge-info=;color=;display-name={author};id={next(self.ids)};"
+                f"tmi-sent-ts={sent};user-type= "
+                f":{author}!{author}@{author}.tmi.twitch.tv PRIVMSG #{channel} :{text}\r\n"
+            ).encode()
+            for author, text in zip(authors, texts)
+        )
+
+
+class ChatServer:
+    """Accepts clients and sends `rate` messages per second to each joined channel"""
+    def __init__(self, rate: float, generator: MessageGenerator, port: int = 0):
+        self.rate = rate
+        self.generator = generator
+        self.listener = socket.create_server((HOST, port))
+        self.port = self.listener.getsockname()[1]
+        # Maps socket to [receive buffer, joined channel or None, messages sent]
+        self.clients = {}
+        self.sent = 0
+        self.started: float = None
+
+    def serve(self, seconds: float):
+        """Serve for `seconds` after the first JOIN (or until then, if nobody joins)"""
+        deadline = time.monotonic() + seconds
+        last_ping = time.monotonic()
+        while time.monotonic() < (deadline if self.started is None else self.started + seconds):
+            readable, _, _ = select.select([self.listener, *self.clients], [], [], 0.001)
+            for sock in readable:
+                if sock is self.listener:
+                    client, _ = sock.accept()
+                    client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    self.clients[client] = [b"", None, 0]
+                else:
+                    self._receive(sock)
+
+            now = time.monotonic()
+            if now - last_ping > PING_INTERVAL:
+                self._broadcast(b"PING :tmi.twitch.tv\r\n")
+                last_ping = now
+
+            if self.started is not None:
+                self._flood(now)
+
+        for client in list(self.clients):
+            client.close()
+        self.listener.close()
+
+    def _flood(self, now: float):
+        for sock, client in list(self.clients.items()):
+            channel = client[1]
+            if channel is None:
+                continue
+
+            due = int((now - self.started) * self.rate) - client[2]
+            if due > 0:
+                try:
+                    sock.sendall(self.generator.lines(channel, due))
+                except OSError:
+                    self._drop(sock)
+                    continue
+                client[2] += due
+                self.sent += due
+
+    def _receive(self, sock: socket.socket):
+        try:
+            data = sock.recv(1 << 16)
+        except OSError:
+            data = b""
+        if not data:
+            self._drop(sock)
+            return
+
+        client = self.clients[sock]
+        *lines, client[0] = (client[0] + data).split(b"\r\n")
+        for line in lines:
+            command, _, argument = line.decode(errors="replace").partition(" ")
+            if command == "CAP":
+                self._send(sock, f":tmi.twitch.tv CAP * ACK :{argument.split(':', 1)[-1]}")
+            elif command == "NICK":
+                self._send(sock, f":tmi.twitch.tv 001 {argument} :Welcome, GLHF!")
+            elif command == "PING":
+                self._send(sock, f":tmi.twitch.tv PONG tmi.twitch.tv {argument}")
+            elif command == "JOIN":
+                channel = argument.lstrip("#")
+                self._send(sock, f":justinfan!justinfan@justinfan.tmi.twitch.tv JOIN #{channel}")
+                self._send(sock, f":justinfan.tmi.twitch.tv 366 justinfan #{channel} :End of /NAMES list")
+                client[1] = channel
+                if self.started is None:
+                    self.started = time.monotonic()
+            elif command == "PART":
+                client[1] = None
+
+    def _send(self, sock: socket.socket, line: str):
+        try:
+            sock.sendall(line.encode() + b"\r\n")
+        except OSError:
+            self._drop(sock)
+
+    def _broadcast(self, data: bytes):
+        for sock in list(self.clients):
+            try:
+                sock.sendall(data)
+            except OSError:
+                self._drop(sock)
+
+    def _drop(self, sock: socket.socket):
+        self.clients.pop(sock, None)
+        sock.close()
+
+
+def serve(rate: float, seconds: float, seed: int, ports, results):
+    """Run a ChatServer, for use as a multiprocessing target
+
+    The server's port is put on `ports`, and the number of messages it sent
+    on `results` once it is done.
+    """
+    server = ChatServer(rate, MessageGenerator(seed=seed))
+    ports.put(server.port)
+    server.serve(seconds)
+    results.put(server.sent)
+
+
+def parse_tags(tags: str) -> dict:
+    return dict(tag.partition("=")[::2] for tag in tags.split(";"))
+
+
+class IrcChannel:
+    """listen_to_twitch.Channel, connected to a ChatServer
+
+    Logs in anonymously, as a read-only client does on Twitch, answers the
+    server's PINGs, and parses tagged PRIVMSGs into Messages, which also carry
+    the server's send time (`sent`, in epoch seconds).
+    """
+    def __init__(self, name: str, port: int, host: str = HOST):
+        self.name = name
+        self.sock = socket.create_connection((host, port))
+        self.sock.setblocking(False)
+        self.buffer = b""
+        self.received = 0
+        self.sock.sendall(
+            b"CAP REQ :twitch.tv/tags twitch.tv/commands\r\n"
+            b"PASS SCHMOOPIIE\r\n"
+            b"NICK justinfan12345\r\n"
+            + f"JOIN #{name}\r\n".encode()
+        )
+
+    def new_messages(self) -> Iterator[Message]:
+        while True:
+            try:
+                data = self.sock.recv(1 << 18)
+            except BlockingIOError:
+                return
+            if not data:
+                raise ConnectionError("Chat server closed the connection")
+
+            *lines, self.buffer = (self.buffer + data).split(b"\r\n")
+            for line in lines:
+                message = self._parse(line.decode(errors="replace"))
+                if message is not None:
+                    self.received += 1
+                    yield message
+
+    def close(self):
+        self.sock.close()
+
+    def _parse(self, line: str) -> Message:
+        tags = {}
+        if line.startswith("@"):
+            raw, _, line = line.partition(" ")
+            tags = parse_tags(raw[1:])
+
+        if line.startswith("PING"):
+            self.sock.sendall(b"PONG" + line[4:].encode() + b"\r\n")
+            return None
+
+        prefix, _, rest = line.partition(" ")
+        command, _, rest = rest.partition(" ")
+        if command != "PRIVMSG":
+            return None
+
+        _, _, content = rest.partition(" :")
+        message = Message(tags.get("display-name") or prefix[1:].partition("!")[0], content)
+        message.sent = int(tags.get("tmi-sent-ts", 0)) / 1000
+        return message
@@ -0,0 +1,196 @@
+"""Replay scripted parrot noise sequences through the input pipeline, headless
+
+Noise events are dispatched to the actions bound to them in parrot.talon, with
+talon, vgamepad and listen_to_twitch replaced by the stand-ins in
+bench/standins.py. Time is virtual, so the latencies reported are those of
+the pipeline's own scheduling (debounce windows, frame alignment), while the
+CPU costs are measured on the real clock.
+
+Run from the repository root:
+
+    python -m bench.replay mixed --seconds 120 --seed 1
+    python -m bench.replay --trace recordings/20260101-200000.noises
+"""
+import argparse
+import ast
+import gc
+import importlib
+import random
+import re
+import sys
+import time
+import types
+
+from collections import Counter
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+from . import standins
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# The name the repository is imported as, so its relative imports resolve
+PACKAGE = "sm64"
+
+CONTINUOUS = ["whis_hi", "whis_lo", "ll", "rr"]
+DISCRETE = ["wa", "hoo", "ho", "yuh", "kk", "tut", "shh", "sss"]
+
+def load_package():
+    """Install the stand-ins and import mapping.py (and everything it uses)"""
+    standins.install()
+    package = types.ModuleType(PACKAGE)
+    package.__path__ = [str(ROOT)]
+    sys.modules[PACKAGE] = package
+    return importlib.import_module(f"{PACKAGE}.mapping")
+
+
+def parse_parrot(path: Path = ROOT / "parrot.talon") -> Dict[str, List[Tuple[str, tuple]]]:
+    """Map each parrot(...) rule to the user actions and arguments it calls
+
+    Keys are noise names as written in the rule, e.g. 'wa', 'whis_hi',
+    'whis_hi:stop' or 'shh:repeat'.
+    """
+    bindings = {}
+    noise = None
+    for line in path.read_text().splitlines():
+        if match := re.match(r"^parrot\((\S+)\):\s*$", line):
+            noise = match.group(1)
+            bindings[noise] = []
+        elif noise and (match := re.match(r"^\s+user\.(\w+)\((.*)\)\s*$", line)):
+            bindings[noise].append((match.group(1), ast.literal_eval(f"({match.group(2)},)")))
+        else:
+            noise = None
+    return bindings
+
+
+def load_trace(path: Path) -> List[Tuple[float, str]]:
+    """(time, noise rule) events from a trace written by recorder.Recorder"""
+    from sm64.recorder import read_trace, STOP, REPEAT
+
+    suffix = {STOP: ":stop", REPEAT: ":repeat"}
+    events = [(event.time, event.noise + suffix.get(event.flag, "")) for event in read_trace(path)]
+    start = events[0][0] - 0.1 if events else 0
+    return [(when - start, noise) for when, noise in events]
+
+
+def sustained(start: float, noise: str, duration: float) -> List[Tuple[float, str]]:
+    return [(start, noise), (start + duration, f"{noise}:stop")]
+
+
+def whistles(seconds: float, rng: random.Random) -> List[Tuple[float, str]]:
+    """March, then alternate long whistles and turns"""
+    events = [(0.1, "cluck")]
+    t = 0.5
+    while t < seconds:
+        noise = rng.choice(CONTINUOUS)
+        duration = rng.uniform(0.2, 2.0)
+        events += sustained(t, noise, duration)
+        t += duration + rng.uniform(0.1, 0.5)
+    return events
+
+
+def mixed(seconds: float, rng: random.Random) -> List[Tuple[float, str]]:
+    """Discrete noises interleaved with (occasionally overlapping) sustained ones"""
+    events = []
+    t = 0.1
+    while t < seconds:
+        if rng.random() < 0.3:
+            events += sustained(t, rng.choice(CONTINUOUS), rng.uniform(0.02, 1.5))
+        else:
+            events.append((t, rng.choice(DISCRETE + ["cluck", "cluck_low"])))
+        t += rng.expovariate(4)
+    return sorted(events)
+
+
+def flurry(seconds: float, rng: random.Random) -> List[Tuple[float, str]]:
+    """Rapid discrete noises and misclassified blips, as fast as parrot emits them"""
+    events = []
+    t = 0.1
+    while t < seconds:
+        if rng.random() < 0.2:
+            # Too short to survive debouncing
+            events += sustained(t, rng.choice(CONTINUOUS), 0.01)
+        else:
+            events.append((t, rng.choice(DISCRETE)))
+        t += rng.uniform(0.02, 0.08)
+    return sorted(events)
+
+
+SCENARIOS = dict(whistles=whistles, mixed=mixed, flurry=flurry)
+
+
+def percentile(values: List[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))] if values else 0
+
+
+def replay(events: List[Tuple[float, str]], bindings: Dict[str, List[Tuple[str, tuple]]], tail: float = 1.0):
+    """Dispatch each (time, noise) event at its virtual time. Returns per-event CPU seconds"""
+    user = standins.actions.user
+    dispatch = []
+
+    for when, noise in events:
+        standins.cron.advance_to(when)
+        start = standins.real_perf_counter()
+        for action, args in bindings[noise]:
+            standins.run_logged(getattr(user, action), *args)
+        dispatch.append(standins.real_perf_counter() - start)
+
+    standins.cron.advance(tail)
+    return dispatch
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("scenario", choices=SCENARIOS, nargs="?", default="mixed")
+    parser.add_argument("--seconds", type=float, default=60, help="Virtual length of the script")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--trace", type=Path, help="Replay a recorded noise trace instead of a scenario")
+    args = parser.parse_args()
+
+    load_package()
+    from sm64.controller import gamepad
+    from sm64.cron_jobs import Job
+    from sm64.frame_clock import FrameClock
+    from sm64.latency import Latency
+
+    bindings = parse_parrot()
+    if args.trace:
+        args.scenario = args.trace.name
+        events = load_trace(args.trace)
+        args.seconds = events[-1][0] if events else 0
+    else:
+        events = SCENARIOS[args.scenario](args.seconds, random.Random(args.seed))
+
+    gc.collect()
+    cpu_start = time.process_time()
+    dispatch = replay(events, bindings)
+    cpu = time.process_time() - cpu_start
+
+    frames = FrameClock.frame
+    per_frame = Counter(int(report[0] / FrameClock.period) for report in gamepad.reports)
+
+    print(f"scenario {args.scenario}: {len(events)} events over {args.seconds:.0f}s virtual, {frames} frames")
+    print(f"cpu: {cpu*1000:.1f}ms total, {len(events)/cpu:,.0f} events/s, {cpu/max(frames, 1)*1e6:.1f}us per frame")
+    print(
+        f"dispatch: mean {sum(dispatch)/len(dispatch)*1e6:.1f}us  "
+        f"p99 {percentile(dispatch, 99)*1e6:.1f}us  max {max(dispatch)*1e6:.1f}us"
+    )
+    print(
+        f"reports: {len(gamepad.reports)} total, {len(gamepad.reports)/max(frames, 1):.2f} per frame, "
+        f"max {max(per_frame.values(), default=0)} in one frame"
+    )
+    if standins.errors:
+        kinds = Counter(f"{type(error).__name__}: {error}" for error in standins.errors)
+        print(f"errors: {len(standins.errors)}")
+        for kind, count in kinds.most_common():
+            print(f"  {count:>5}x {kind}")
+
+    print("\nlatency (virtual time):")
+    print(Latency.summary())
+    print("\njob timing (virtual time):")
+    print(Job.jitter_summary())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+"""Stand-ins for talon, vgamepad and listen_to_twitch, for running headless
+
+Only what this package uses is provided. Time is virtual: install() replaces
+time.perf_counter and time.monotonic with a clock that only moves when
+VirtualCron.advance is called, so replays are deterministic.
+"""
+import enum
+import heapq
+import itertools
+import sys
+import time
+import types
+
+from collections import deque
+from typing import Callable, Dict, List
+
+# The real clocks, for measuring the harness itself
+real_perf_counter = time.perf_counter
+real_monotonic = time.monotonic
+
+class VirtualClock:
+    now: float = 0.0
+
+    @classmethod
+    def time(cls) -> float:
+        return cls.now
+
+
+def parse_duration(duration: str) -> float:
+    """Seconds in a talon duration string such as '34ms' or '2s'"""
+    if duration.endswith("ms"):
+        return float(duration[:-2]) / 1000
+    if duration.endswith("s"):
+        return float(duration[:-1])
+    raise ValueError(f"Unrecognized duration '{duration}'")
+
+
+# Every exception raised by an action or timer callback
+errors: List[Exception] = []
+
+def run_logged(function: Callable, *args):
+    """Call function like talon does: exceptions are logged and do not propagate"""
+    try:
+        return function(*args)
+    except Exception as error:
+        errors.append(error)
+
+
+class VirtualCron:
+    """talon.cron, run on virtual time"""
+    def __init__(self):
+        # Heap of (deadline, handle, function, repeat interval or None)
+        self.queue = []
+        self.cancelled = set()
+        self.counter = itertools.count()
+
+    def after(self, duration: str, function: Callable):
+        return self._push(parse_duration(duration), function, None)
+
+    def interval(self, duration: str, function: Callable):
+        interval = parse_duration(duration)
+        return self._push(interval, function, interval)
+
+    def cancel(self, handle):
+        self.cancelled.add(handle)
+
+    def advance(self, seconds: float):
+        self.advance_to(VirtualClock.now + seconds)
+
+    def advance_to(self, end: float):
+        """Run every timer due up to `end`, in deadline order"""
+        while self.queue and self.queue[0][0] <= end:
+            deadline, handle, function, interval = heapq.heappop(self.queue)
+            if handle in self.cancelled:
+                self.cancelled.discard(handle)
+                continue
+
+            VirtualClock.now = max(VirtualClock.now, deadline)
+            if interval is not None:
+                heapq.heappush(self.queue, (deadline + interval, handle, function, interval))
+            run_logged(function)
+
+        VirtualClock.now = max(VirtualClock.now, end)
+
+    def _push(self, delay: float, function: Callable, interval: float):
+        handle = next(self.counter)
+        heapq.heappush(self.queue, (VirtualClock.now + delay, handle, function, interval))
+        return handle
+
+
+class ActionRegistry:
+    """The `actions.user` namespace
+
+    Implementations from Context.action_class take precedence over the
+    declarations from Module.action_class. Actions neither declares (e.g. those
+    provided by other user scripts, like hud_add_log) are recorded and ignored.
+    """
+    def __init__(self):
+        self.declared: Dict[str, Callable] = {}
+        self.implemented: Dict[str, Callable] = {}
+        self.unhandled: Dict[str, List[tuple]] = {}
+
+    def __getattr__(self, name: str):
+        # Resolved at call time, like talon, so modules can bind actions early
+        def call(*args, **kwargs):
+            if name in self.implemented:
+                return self.implemented[name](*args, **kwargs)
+            if name in self.declared:
+                return self.declared[name](*args, **kwargs)
+            self.unhandled.setdefault(name, []).append(args)
+        return call
+
+
+def _functions(cls) -> Dict[str, Callable]:
+    return {name: value for name, value in vars(cls).items() if callable(value)}
+
+
+class Module:
+    def __init__(self):
+        self.apps = types.SimpleNamespace()
+
+    def action_class(self, cls):
+        actions.user.declared.update(_functions(cls))
+        return cls
+
+
+class Context:
+    matches: str = ""
+
+    def action_class(self, path: str):
+        def register(cls):
+            actions.user.implemented.update(_functions(cls))
+            return cls
+        return register
+
+
+actions = types.SimpleNamespace(user=ActionRegistry())
+cron = VirtualCron()
+
+
+class XUSB_BUTTON(enum.IntFlag):
+    XUSB_GAMEPAD_DPAD_UP = 0x0001
+    XUSB_GAMEPAD_DPAD_DOWN = 0x0002
+    XUSB_GAMEPAD_DPAD_LEFT = 0x0004
+    XUSB_GAMEPAD_DPAD_RIGHT = 0x0008
+    XUSB_GAMEPAD_START = 0x0010
+    XUSB_GAMEPAD_BACK = 0x0020
+    XUSB_GAMEPAD_LEFT_THUMB = 0x0040
+    XUSB_GAMEPAD_RIGHT_THUMB = 0x0080
+    XUSB_GAMEPAD_LEFT_SHOULDER = 0x0100
+    XUSB_GAMEPAD_RIGHT_SHOULDER = 0x0200
+    XUSB_GAMEPAD_GUIDE = 0x0400
+    XUSB_GAMEPAD_A = 0x1000
+    XUSB_GAMEPAD_B = 0x2000
+    XUSB_GAMEPAD_X = 0x4000
+    XUSB_GAMEPAD_Y = 0x8000
+
+
+class RecordingGamepad:
+    """vgamepad.VX360Gamepad that records every report instead of sending it
+
+    Each report is (virtual time, buttons, left trigger, right trigger, left
+    stick x, left stick y, right stick x, right stick y).
+    """
+    def __init__(self):
+        self.buttons = 0
+        self.triggers = [0, 0]
+        self.sticks = [0, 0, 0, 0]
+        self.reports = []
+
+    def press_button(self, button):
+        self.buttons |= int(button)
+
+    def release_button(self, button):
+        self.buttons &= ~int(button)
+
+    def left_trigger(self, value: int):
+        self.triggers[0] = value
+
+    def right_trigger(self, value: int):
+        self.triggers[1] = value
+
+    def left_joystick(self, x_value: int, y_value: int):
+        self.sticks[0:2] = [x_value, y_value]
+
+    def right_joystick(self, x_value: int, y_value: int):
+        self.sticks[2:4] = [x_value, y_value]
+
+    def left_joystick_float(self, x_value_float: float, y_value_float: float):
+        self.left_joystick(round(x_value_float * 32767), round(y_value_float * 32767))
+
+    def right_joystick_float(self, x_value_float: float, y_value_float: float):
+        self.right_joystick(round(x_value_float * 32767), round(y_value_float * 32767))
+
+    def update(self):
+        self.reports.append((VirtualClock.now, self.buttons, *self.triggers, *self.sticks))
+
+
+class Channel:
+    """listen_to_twitch.Channel, fed by `push` instead of a Twitch connection"""
+    def __init__(self, name: str):
+        self.name = name
+        self.inbox = deque()
+
+    def push(self, message):
+        self.inbox.append(message)
+
+    def new_messages(self):
+        while self.inbox:
+            yield self.inbox.popleft()
+
+    def close(self):
+        self.inbox.clear()
+
+
+class Message:
+    def __init__(self, author: str, content: str):
+        self.author = author
+        self.content = content
+
+    def __repr__(self):
+        return f"{self.author}: {self.content}"
+
+
+def _module(name: str, **attributes) -> types.ModuleType:
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+def install():
+    """Register the stand-ins in sys.modules and switch time to the virtual clock"""
+    _module("talon", Module=Module, Context=Context, actions=actions, cron=cron)
+    _module("vgamepad", XUSB_BUTTON=XUSB_BUTTON, VX360Gamepad=RecordingGamepad)
+
+    twitch = _module("listen_to_twitch", Channel=Channel)
+    twitch.message = _module("listen_to_twitch.message", Message=Message)
+
+    time.perf_counter = VirtualClock.time
+    time.monotonic = VirtualClock.time
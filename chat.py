@@ -1,78 +1,338 @@
-import time
+import heapq
 import logging
+import threading
+import time
 
-from typing import Callable
+from collections import OrderedDict, deque
+from typing import Callable, Dict, Optional
 from talon import actions
-from dataclasses import dataclass
 
 from .cron_jobs import Job
+from .frame_clock import FrameClock
 
 from listen_to_twitch import Channel
-from listen_to_twitch.respond import ResponseManager, Action
 from listen_to_twitch.message import Message
 
+# Twitch channel whose chat is listened to
+CHANNEL = "ecneicscience"
+
+# Most commands that can wait to be dispatched. A command arriving while the
+# queue is full drops the oldest one, so no command waits more than
+# QUEUE_SIZE / MAX_PER_FRAME frames however fast chat is
+QUEUE_SIZE = 32
+
+# Most queued commands dispatched per frame, so chat can never stall the
+# frame loop
+MAX_PER_FRAME = 8
+
+# Each author may send AUTHOR_BURST commands at once, then AUTHOR_RATE
+# commands per second. Commands past that are dropped
+AUTHOR_RATE = 1.0
+AUTHOR_BURST = 3
+
+# Authors tracked at most. Past that, the least recently active is forgotten
+MAX_AUTHORS = 4096
+
+# Seconds the reader thread waits before polling again when chat is quiet
+POLL_INTERVAL = 0.02
+
+# Seconds waited before reconnecting after the connection fails, doubling
+# with each consecutive failure up to RECONNECT_MAX. A connection that stays
+# up for RECONNECT_MAX seconds resets the wait
+RECONNECT_MIN = 1.0
+RECONNECT_MAX = 60.0
+
+# Seconds without any message after which the connection is presumed dead
+# and reopened. Twitch pings every 5 minutes, so this only fires on a dead
+# connection or a very quiet channel
+IDLE_TIMEOUT = 600.0
+
+# While voting, commands are counted instead of queued, and every window of
+# VOTE_WINDOW_FRAMES frames the VOTE_WINNERS most voted distinct commands are
+# dispatched once each
+VOTE_WINDOW_FRAMES = 30
+VOTE_WINNERS = 1
+
+# Longest author name shown on the HUD
+MAX_NAME_LENGTH = 16
+
+# Why commands are dropped, as counted in ChatHack.drops
+RATE_LIMITED = "rate limited"
+EVICTED = "evicted"
+
+class TokenBuckets:
+    """Per-author token buckets, refilled at `rate` tokens per second up to `burst`
+
+    At most `capacity` buckets are kept. A new author past that evicts the
+    least recently active one, which then starts full if it comes back.
+    """
+    def __init__(self, rate: float, burst: float, capacity: int):
+        self.rate = rate
+        self.burst = burst
+        self.capacity = capacity
+        # Maps author to [tokens, time of the last refill], least recently
+        # active first
+        self.buckets: Dict[str, list] = OrderedDict()
+
+    def take(self, author: str) -> bool:
+        """Spend one of the author's tokens, if they have one"""
+        now = time.monotonic()
+        bucket = self.buckets.get(author)
+        if bucket is None:
+            if len(self.buckets) >= self.capacity:
+                self.buckets.popitem(last=False)
+            bucket = self.buckets[author] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            self.buckets.move_to_end(author)
+
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+    def clear(self):
+        self.buckets.clear()
+
+
 class ChatHack:
+    """Reads chat on a background thread, so the Talon thread never touches the network
+
+    The reader connects to the channel once and keeps the connection open,
+    reconnecting with exponential backoff whenever it fails or goes quiet for
+    IDLE_TIMEOUT, and skipping the backlog each time it connects. Toggling
+    only enables or disables dispatch: while disabled, messages are read and
+    discarded.
+
+    While enabled, each message is matched against the command index and
+    (keyword, message) is queued for the ones that are commands and within
+    their author's rate limit. process_new_messages dispatches them from the
+    frame loop. Connection failures are kept in `error` until reported, and
+    dropped commands are counted by reason in `drops`.
+
+    While voting, the reader instead counts each keyword in `votes`, so a
+    window costs one dispatch per winner however many messages arrived.
+    """
     active: bool = False
-    channel = None
+    voting: bool = False
+    inbox = deque(maxlen=QUEUE_SIZE)
+    limits = TokenBuckets(AUTHOR_RATE, AUTHOR_BURST, MAX_AUTHORS)
+    # Maps keyword to its count in the current vote window
+    votes: Dict[str, int] = {}
+    lock = threading.Lock()
+    drops: Dict[str, int] = {RATE_LIMITED: 0, EVICTED: 0}
+    error: Exception = None
+    reconnects: int = 0
+    reader: threading.Thread = None
+    closing: threading.Event = None
 
     @classmethod
-    def init(cls):
-        cls.channel = Channel("ecneicscience")
+    def enable(cls):
+        cls.inbox.clear()
+        cls.limits.clear()
+        cls.clear_votes()
+        cls.drops = dict.fromkeys(cls.drops, 0)
+        cls.active = True
+        cls.connect()
 
     @classmethod
-    def reset(cls):
-        try: cls.channel.close()
-        except: pass
-        cls.init()
-
-def wrap(func: Callable):
-    max_len = 16
-    def inner(msg: Message):
-        author = msg.author
-        if len(author) > max_len:
-            author = author[:max_len-3] + "..."
-        return func(author)
-    return inner
+    def disable(cls):
+        cls.active = False
+
+    @classmethod
+    def connect(cls):
+        """Start the reader, unless it is already running"""
+        if cls.reader is not None and cls.reader.is_alive():
+            return
+
+        cls.error = None
+        cls.closing = threading.Event()
+        cls.reader = threading.Thread(
+            target = cls._read,
+            args = (cls.closing,),
+            name = "ChatHack reader",
+            daemon = True,
+        )
+        cls.reader.start()
+
+    @classmethod
+    def close(cls):
+        """Stop the reader and close the connection"""
+        # The reader may be blocked on the network, so it is not joined
+        cls.active = False
+        if cls.reader is not None:
+            cls.closing.set()
+            cls.reader = None
+
+    @classmethod
+    def clear_votes(cls) -> Dict[str, int]:
+        """Empty the vote tally, returning what it held"""
+        with cls.lock:
+            votes, cls.votes = cls.votes, {}
+        return votes
+
+    @classmethod
+    def _read(cls, closing: threading.Event):
+        backoff = RECONNECT_MIN
+        while not closing.is_set():
+            channel = None
+            connected = time.monotonic()
+            try:
+                channel = Channel(CHANNEL)
+                skip_backlog(channel)
+                cls._listen(channel, closing)
+            except Exception as error:
+                cls.error = error
+            finally:
+                try: channel.close()
+                except: pass
+
+            if closing.is_set():
+                return
+
+            if time.monotonic() - connected >= RECONNECT_MAX:
+                backoff = RECONNECT_MIN
+            cls.reconnects += 1
+            closing.wait(backoff)
+            backoff = min(backoff * 2, RECONNECT_MAX)
+
+    @classmethod
+    def _listen(cls, channel: Channel, closing: threading.Event):
+        """Handle new messages until closing, or until the channel goes quiet"""
+        last_received = time.monotonic()
+        while not closing.is_set():
+            received = False
+            for message in channel.new_messages():
+                received = True
+                if not cls.active:
+                    continue
+
+                keyword = manager.match(message.content)
+                if keyword is None:
+                    continue
+
+                if not cls.limits.take(message.author):
+                    cls.drops[RATE_LIMITED] += 1
+                    continue
+
+                if cls.voting:
+                    with cls.lock:
+                        cls.votes[keyword] = cls.votes.get(keyword, 0) + 1
+                    continue
+
+                # Appending to a full inbox evicts its oldest command
+                if len(cls.inbox) == QUEUE_SIZE:
+                    cls.drops[EVICTED] += 1
+                cls.inbox.append((keyword, message))
+
+            if received:
+                last_received = time.monotonic()
+            elif time.monotonic() - last_received > IDLE_TIMEOUT:
+                return
+            else:
+                closing.wait(POLL_INTERVAL)
 
-def timed(start_fn: Callable, end_fn: Callable, dur: float = 5):
-    def inner(msg: Message):
-        wrap(start_fn)(msg)
-        print(Job.jobs.keys())
-        time.sleep(dur)
-        end_fn()
-        print(Job.jobs.keys())
+def author_name(message: Message) -> str:
+    author = message.author
+    if len(author) > MAX_NAME_LENGTH:
+        author = author[:MAX_NAME_LENGTH-3] + "..."
+    return author
+
+def timed(name: str, start_fn: Callable, end_fn: Callable, dur: float = 5):
+    """Start now and end after dur seconds, without waiting
+
+    The end is a named job, so a repeat while one is running just postpones
+    it, and any number of viewers can keep a pulse going.
+    """
+    def inner(label: str):
+        if not Job.active(name):
+            start_fn(label)
+        Job.after(name=name, function=end_fn, frames=FrameClock.to_frames(dur * 1000))
     return inner
 
+class CommandIndex:
+    """Chat commands indexed by keyword
+
+    Messages are matched case-insensitively on the words following the prefix.
+    Anything without the prefix is rejected by one startswith check, and
+    anything else costs one dict lookup per distinct keyword length, however
+    many commands there are. Handlers are called with the name to show on the
+    HUD.
+    """
+    def __init__(self, prefix: str, commands: Dict[str, Callable]):
+        self.prefix = prefix.lower()
+        self.commands = {" ".join(keyword.lower().split()): handler for keyword, handler in commands.items()}
+        self.lengths = sorted({len(keyword.split()) for keyword in self.commands}, reverse=True)
+
+    def match(self, text: str) -> Optional[str]:
+        """The keyword of the command in text, if any"""
+        text = text.lower()
+        if not text.startswith(self.prefix) or not text[len(self.prefix):len(self.prefix)+1].isspace():
+            return None
+
+        words = text[len(self.prefix):].split()
+        for length in self.lengths:
+            keyword = " ".join(words[:length])
+            if keyword in self.commands:
+                return keyword
+        return None
+
+    def process(self, message: Message) -> bool:
+        keyword = self.match(message.content)
+        if keyword is not None:
+            self.commands[keyword](author_name(message))
+        return keyword is not None
+
 prefix = "!hack"
 au = actions.user
 
-manager = ResponseManager([
-    Action(prefix, "run", wrap(au.march_fast)),
-    Action(prefix, "walk", wrap(au.march_slow)),
-    Action(prefix, "invert", wrap(au.joystick_invert)),
-    Action(prefix, "rotate right", wrap(au.joystick_cw)),
-    Action(prefix, "rotate left", wrap(au.joystick_ccw)),
-    Action(prefix, "straighten", wrap(au.joystick_forward)),
-    Action(prefix, "jump", wrap(au.single_jump)),
-    Action(prefix, "punch", wrap(au.punch)),
-    Action(prefix, "pound", wrap(au.ground_pound)),
-    Action(prefix, "camera", wrap(au.camera_toggle)),
-    Action(prefix, "zoom in", wrap(au.camera_in)),
-    Action(prefix, "zoom out", wrap(au.camera_out)),
-    Action(prefix, "cam left", wrap(au.camera_left)),
-    Action(prefix, "cam right", wrap(au.camera_right)),
-    Action(prefix, "start", wrap(au.press_start)),
-    Action(prefix, "pulse left", timed(au.ll_start, au.ll_stop)),
-    Action(prefix, "pulse right", timed(au.ll_start, au.ll_stop)),
-    Action(prefix, "pulse up", timed(au.whis_hi_start, au.whis_hi_stop)),
-    Action(prefix, "pulse down", timed(au.whis_lo_start, au.whis_lo_stop)),
-])
-    
-def process_new_messages():
-    for message in ChatHack.channel.new_messages():
-        logging.debug(f"{message}")
-        manager.process(message)
-
-def clear_old_messages():
-    for message in ChatHack.channel.new_messages():
-        continue
+manager = CommandIndex(prefix, {
+    "run": au.march_fast,
+    "walk": au.march_slow,
+    "invert": au.joystick_invert,
+    "rotate right": au.joystick_cw,
+    "rotate left": au.joystick_ccw,
+    "straighten": au.joystick_forward,
+    "jump": au.single_jump,
+    "punch": au.punch,
+    "pound": au.ground_pound,
+    "camera": au.camera_toggle,
+    "zoom in": au.camera_in,
+    "zoom out": au.camera_out,
+    "cam left": au.camera_left,
+    "cam right": au.camera_right,
+    "start": au.press_start,
+    "pulse left": timed("pulse_left", au.ll_start, au.ll_stop),
+    "pulse right": timed("pulse_right", au.rr_start, au.rr_stop),
+    "pulse up": timed("pulse_up", au.whis_hi_start, au.whis_hi_stop),
+    "pulse down": timed("pulse_down", au.whis_lo_start, au.whis_lo_stop),
+})
+
+
+def process_new_messages(limit: int = MAX_PER_FRAME):
+    """Dispatch messages queued by the reader thread"""
+    for _ in range(limit):
+        try:
+            keyword, message = ChatHack.inbox.popleft()
+        except IndexError:
+            return
+
+        # Formatting is deferred, so it costs nothing unless debug logging is on
+        logging.debug("%s", message)
+        manager.commands[keyword](author_name(message))
+
+def process_votes(winners: int = VOTE_WINNERS):
+    """End the vote window, dispatching the most voted commands
+
+    Each winner is dispatched once, with its vote count shown on the HUD in
+    place of an author name.
+    """
+    votes = ChatHack.clear_votes()
+    for keyword, count in heapq.nlargest(winners, votes.items(), key=lambda item: item[1]):
+        logging.debug("%s: %d votes", keyword, count)
+        manager.commands[keyword](f"{count} votes")
+
+def skip_backlog(channel: Channel):
+    """Discard every message already received, in one pass"""
+    deque(channel.new_messages(), maxlen=0)
@@ -1,10 +1,11 @@
 from talon import Context
-from dataclasses import dataclass
+from dataclasses import dataclass, field
+
+from .cron_jobs import Job, Scheduler
+from .latency import Latency
 
 import vgamepad as vg
 import math
-import time
-import numpy as np
 
 ctx = Context()
 ctx.matches = r"""
@@ -14,35 +15,89 @@ mode: user.single_application
 
 gamepad = vg.VX360Gamepad()
 
-key_hold: float = 34
-sleep = lambda ms: time.sleep(ms/1000)
+# Full deflection of an analog stick axis, in the driver's integer units
+STICK_MAX: int = 32767
+
+# Number of distinct stick directions. At half a degree per step, the
+# rotation tunables in mapping.py are a whole number of steps
+ANGLE_STEPS: int = 720
+ANGLE_STEP: float = 360 / ANGLE_STEPS
+ANGLE_RAD: float = 2*math.pi / ANGLE_STEPS
+
+# Unit vector of each direction, indexed by angle step
+COS = [math.cos(i * ANGLE_RAD) for i in range(ANGLE_STEPS)]
+SIN = [math.sin(i * ANGLE_RAD) for i in range(ANGLE_STEPS)]
+
+def report():
+    """Send the gamepad state, or just mark it dirty while in commit mode"""
+    if Controller.commit_mode:
+        Controller.dirty = True
+    else:
+        gamepad.update()
+        Latency.reported()
+
 
 @dataclass
 class Button:
     _id: vg.XUSB_BUTTON
     held: bool = False
+    presses: int = 0
+    changed_at: int = -1 # Controller.commits when last held or released
 
     def press(self, frames: int=1):
+        """Hold for some frames. Returns immediately, the release is scheduled"""
         assert frames > 0
-        self.hold()
-        sleep(key_hold * frames)
-        self.release()
+        self.presses += 1
+        self._start_press(self.presses, frames)
 
     def hold(self):
         gamepad.press_button(self._id)
-        gamepad.update()
+        report()
         self.held = True
+        self.changed_at = Controller.commits
 
     def release(self):
         gamepad.release_button(self._id)
-        gamepad.update()
+        report()
         self.held = False
+        self.changed_at = Controller.commits
+
+    def _start_press(self, press: int, frames: int):
+        # A newer press of the same button replaces this one
+        if press != self.presses:
+            return
+
+        if self.held or Controller.unsent(self.changed_at):
+            # Pressing a held button would only extend the hold, so it is let
+            # go for a frame first, to be seen as a new press
+            if self.held and not Controller.unsent(self.changed_at):
+                self.release()
+            Scheduler.after(1, self._start_press, dict(press=press, frames=frames))
+            return
+
+        self.hold()
+        Scheduler.after(frames, self._end_press, dict(press=press, frames=frames))
+
+    def _end_press(self, press: int, frames: int):
+        # A newer press of the same button owns the release
+        if press != self.presses:
+            return
+
+        if Controller.unsent(self.changed_at):
+            # The frame clock stalled before the hold was committed, so time
+            # the press from the frame it is committed on instead
+            Scheduler.after(frames, self._end_press, dict(press=press, frames=frames))
+            return
+
+        self.release()
 
 
 @dataclass
 class Trigger:
     side: str
     held: bool = False
+    presses: int = 0
+    changed_at: int = -1 # Controller.commits when last held or released
 
     def get_trigger(self):
         if self.side == 'left':
@@ -53,92 +108,240 @@ class Trigger:
             raise ValueError
 
     def press(self, val: float, frames: int=1):
-        """Value between 0 and 1"""
+        """Value between 0 and 1. Returns immediately, the release is scheduled"""
         assert frames > 0
-        self.hold(val)
-        sleep(key_hold * frames)
-        self.release()
+        self.presses += 1
+        self._start_press(self.presses, val, frames)
 
     def hold(self, val: float):
         """Value between 0 and 1"""
         val = self._convert(val)
         self.get_trigger()(value=val)
-        gamepad.update()
+        report()
         self.held = True
+        self.changed_at = Controller.commits
 
     def release(self):
         self.get_trigger()(value=0)
-        gamepad.update()
+        report()
         self.held = False
+        self.changed_at = Controller.commits
+
+    def _start_press(self, press: int, val: float, frames: int):
+        # A newer press of the same trigger replaces this one
+        if press != self.presses:
+            return
+
+        if self.held or Controller.unsent(self.changed_at):
+            # Pressing a held trigger would only extend the hold, so it is let
+            # go for a frame first, to be seen as a new press
+            if self.held and not Controller.unsent(self.changed_at):
+                self.release()
+            Scheduler.after(1, self._start_press, dict(press=press, val=val, frames=frames))
+            return
+
+        self.hold(val)
+        Scheduler.after(frames, self._end_press, dict(press=press, frames=frames))
+
+    def _end_press(self, press: int, frames: int):
+        # A newer press of the same trigger owns the release
+        if press != self.presses:
+            return
+
+        if Controller.unsent(self.changed_at):
+            # The frame clock stalled before the hold was committed, so time
+            # the press from the frame it is committed on instead
+            Scheduler.after(frames, self._end_press, dict(press=press, frames=frames))
+            return
+
+        self.release()
 
     def _convert(self, val: float) -> int:
         """Convert fraction to 0-255 integer range"""
         return int(math.floor(val*255))
 
 
+@dataclass
+class StickDeltas:
+    """Changes contributed to a stick by per-frame effects, within one frame"""
+    # Positions aimed at, as (magnitude, angle step, and those of the
+    # position aimed at on the previous frame)
+    targets: list = field(default_factory=list)
+    dr: float = 0
+    dtheta: float = 0
+    dx: float = 0
+    dy: float = 0
+    min_val: float = 0
+    max_val: float = 1
+    pending: bool = False
+
+
 @dataclass
 class JoyStick:
+    """Analog stick state, kept at the stick's native integer resolution
+
+    The magnitude is an integer in [0, STICK_MAX] and the angle is an index into
+    the ANGLE_STEPS entry direction tables, so rotations by a whole number of
+    steps are exact and the position is a table lookup.
+
+    Per-frame effects contribute deltas instead of changing the stick, and
+    Controller.mix applies them all as one change at the end of the frame.
+    """
     side: str
-    val: float = 0
-    angle: float = 0
+    mag: int = 0
+    step: int = 0
     active: bool = False
+    deltas: StickDeltas = field(default_factory=StickDeltas)
+    # (magnitude, angle step) the last mix left the stick at, so effects can
+    # tell whether anything else has moved it since
+    mixed: tuple = None
+
+    @property
+    def val(self) -> float:
+        """Magnitude between 0 and 1"""
+        return self.mag / STICK_MAX
+
+    @val.setter
+    def val(self, val: float):
+        self.mag = self._quantize_val(val)
+
+    @property
+    def angle(self) -> float:
+        """Angle in degrees [0,360) (right is 0)"""
+        return self.step * ANGLE_STEP
+
+    @angle.setter
+    def angle(self, angle: float):
+        self.step = self._quantize_angle(angle)
 
     def get_joystick(self):
         if self.side == 'left':
-            return gamepad.left_joystick_float
+            return gamepad.left_joystick
         elif self.side == 'right':
-            return gamepad.right_joystick_float
+            return gamepad.right_joystick
         else:
             raise ValueError
 
     def set_polar(self, val: float, angle: float):
         """val between 0 and 1, and angle in degrees [0,360] (right is 0)"""
-        x, y = self._convert_polar(val, angle)
-        self.get_joystick()(x_value_float=x, y_value_float=y)        
-        gamepad.update()
-        self.val = val
-        self.angle = angle
-        self.active = True
+        self._set(self._quantize_val(val), self._quantize_angle(angle))
 
     def set_cartesian(self, x: float, y: float):
-        """x and y between 0 and 1. Behavior when sqrt(x^2+y^2)>1 unknown"""
-        # normalize vector to 1
-        x, y = self._convert_polar(*self._convert_cartesian(x, y))
-        self.get_joystick()(x_value_float=x, y_value_float=y)        
-        gamepad.update()
-        self.val, self.angle = self._convert_cartesian(x, y)
-        self.active = True
+        """x and y between 0 and 1. Vectors longer than 1 are normalized to 1"""
+        self._set(*self._convert_cartesian(x * STICK_MAX, y * STICK_MAX))
 
     def alter_polar(self, dr: float = 0, dtheta: float = 0):
         """Change state based on current state"""
-        if self.val + dr < 0:
-            dr = self.val
-
-        self.set_polar(val=self.val+dr, angle=self.angle+dtheta)
+        mag = self.mag + round(dr * STICK_MAX)
+        self._set(min(max(mag, 0), STICK_MAX), self.step + round(dtheta / ANGLE_STEP))
 
     def alter_cartesian(self, dx: float = 0, dy: float = 0):
         """Change state based on current state"""
-        curr_x, curr_y = self._convert_polar(self.val, self.angle)
-        self.set_cartesian(x=curr_x+dx, y=curr_y+dy)
+        x = self.mag * COS[self.step] + dx * STICK_MAX
+        y = self.mag * SIN[self.step] + dy * STICK_MAX
+        self._set(*self._convert_cartesian(x, y))
+
+    def contribute(self, dr: float = 0, dtheta: float = 0, dx: float = 0, dy: float = 0,
+                   min_val: float = 0, max_val: float = 1):
+        """Add to this frame's change, to be applied by mix
+
+        min_val and max_val bound the magnitude after the radial change. When
+        several effects give bounds, the narrowest of them apply.
+        """
+        deltas = self.deltas
+        deltas.dr += dr
+        deltas.dtheta += dtheta
+        deltas.dx += dx
+        deltas.dy += dy
+        deltas.min_val = max(deltas.min_val, min_val)
+        deltas.max_val = min(deltas.max_val, max_val)
+        deltas.pending = True
+
+    def aim(self, mag: int, step: int, last_mag: int, last_step: int):
+        """Contribute a position for this frame, to be applied by mix
+
+        last_mag and last_step are where the same effect aimed on the previous
+        frame, so that its movement can be combined with other effects'.
+        """
+        self.deltas.targets.append((mag, step, last_mag, last_step))
+        self.deltas.pending = True
+
+    def saturated(self, **deltas) -> bool:
+        """Whether contributing these deltas would leave the stick where it is"""
+        return self.active and self._mixed(StickDeltas(**deltas)) == (self.mag, self.step)
+
+    def mix(self):
+        """Apply this frame's contributions as a single change
+
+        Sums of each kind are applied in a fixed order, so the result does not
+        depend on the order effects ran in: positions aimed at, radial (then
+        the magnitude bounds), angular, and then cartesian, clamped to the unit
+        circle. A single position is taken exactly, while several are combined
+        by adding up how far each has moved since the previous frame.
+        Nothing is sent if the contributions cancel out or are clamped away.
+        """
+        deltas = self.deltas
+        if not deltas.pending:
+            return
+        self.deltas = StickDeltas()
+
+        mag, step = self._mixed(deltas)
+        if not self.active or (mag, step) != (self.mag, self.step):
+            self._set(mag, step)
+        self.mixed = (self.mag, self.step)
 
     def release(self):
-        self.get_joystick()(x_value_float=0, y_value_float=0)
-        gamepad.update()
-        self.val = 0
-        self.angle = 90
+        self.get_joystick()(x_value=0, y_value=0)
+        report()
+        self.mag = 0
+        self.step = ANGLE_STEPS // 4
         self.active = False
 
-    def _convert_polar(self, val: float, angle: float):
-        if val > 1:
-            val = 1
-        rads = math.pi/180 * angle
-        return val*math.cos(rads), val*math.sin(rads)
-        
+    def _set(self, mag: int, step: int):
+        step %= ANGLE_STEPS
+        self.get_joystick()(
+            x_value=round(mag * COS[step]),
+            y_value=round(mag * SIN[step]),
+        )
+        report()
+        self.mag = mag
+        self.step = step
+        self.active = True
+
+    def _mixed(self, deltas: StickDeltas):
+        """(magnitude, angle step) after applying deltas to the current state"""
+        mag, step = self.mag, self.step
+        if len(deltas.targets) == 1:
+            mag, step = deltas.targets[0][:2]
+        elif deltas.targets:
+            x = self.mag * COS[self.step]
+            y = self.mag * SIN[self.step]
+            for m, s, last_m, last_s in deltas.targets:
+                x += m * COS[s] - last_m * COS[last_s]
+                y += m * SIN[s] - last_m * SIN[last_s]
+            mag, step = self._convert_cartesian(x, y)
+
+        mag = mag + round(deltas.dr * STICK_MAX)
+        mag = min(max(mag, self._quantize_val(deltas.min_val)), self._quantize_val(deltas.max_val))
+        step = (step + round(deltas.dtheta / ANGLE_STEP)) % ANGLE_STEPS
+
+        if deltas.dx or deltas.dy:
+            x = mag * COS[step] + deltas.dx * STICK_MAX
+            y = mag * SIN[step] + deltas.dy * STICK_MAX
+            mag, step = self._convert_cartesian(x, y)
+        return mag, step
+
+    def _quantize_val(self, val: float) -> int:
+        return min(max(round(val * STICK_MAX), 0), STICK_MAX)
+
+    def _quantize_angle(self, angle: float) -> int:
+        return round(angle / ANGLE_STEP) % ANGLE_STEPS
+
     def _convert_cartesian(self, x: float, y: float):
-        angle = np.arctan2(y, x) * 180/np.pi # degrees
-        if (val := np.sqrt(x**2 + y**2)) > 1: val = 1
-        return val, angle
-        
+        """Stick units to (magnitude, angle step), clamped to the unit circle"""
+        mag = min(round(math.hypot(x, y)), STICK_MAX)
+        return mag, round(math.atan2(y, x) / ANGLE_RAD) % ANGLE_STEPS
+
 
 class Controller:
     A: Button = Button(vg.XUSB_BUTTON.XUSB_GAMEPAD_A)
@@ -163,3 +366,47 @@ class Controller:
 
     LJoy: JoyStick = JoyStick("left")
     RJoy: JoyStick = JoyStick("right")
+
+    # When commit_mode is on, Button, Trigger and JoyStick changes only mark
+    # the state dirty, and one report with the final state is sent per frame
+    commit_mode: bool = False
+    dirty: bool = False
+    # Number of reports sent by commit
+    commits: int = 0
+
+    @classmethod
+    def mix(cls):
+        """Apply the deltas contributed to each stick this frame"""
+        cls.LJoy.mix()
+        cls.RJoy.mix()
+
+    @classmethod
+    def commit(cls):
+        """Send a single report if anything changed since the last commit"""
+        if cls.dirty:
+            gamepad.update()
+            Latency.reported()
+            cls.dirty = False
+            cls.commits += 1
+
+    @classmethod
+    def unsent(cls, changed_at: int) -> bool:
+        """Whether a change made when commits was changed_at is still waiting to be committed"""
+        return cls.commit_mode and cls.commits == changed_at
+
+    @classmethod
+    def set_commit_mode(cls, enabled: bool):
+        if enabled:
+            # Commit once every frame, after all per-frame effects have run
+            Job.frame_hooks["commit"] = cls.commit
+            Job.start_loop()
+        elif cls.commit_mode:
+            Job.frame_hooks.pop("commit", None)
+            cls.commit()
+
+        cls.commit_mode = enabled
+
+
+# Stick effects are combined once per frame, after all of them have run and
+# before the frame is committed
+Job.frame_hooks["mix"] = Controller.mix
@@ -1,27 +1,239 @@
-from talon import cron
 from typing import Callable, Dict
+from dataclasses import dataclass
+
+from .frame_clock import FrameClock
+
+import heapq
+import itertools
+import time
+
+@dataclass
+class TickStats:
+    """How regularly a named per-frame job has actually been run"""
+    runs: int = 0
+    late: int = 0 # Runs that came more than one period after the previous one
+    missed: int = 0 # Frames skipped over by late runs
+    total_gap: float = 0 # Seconds
+    max_gap: float = 0 # Seconds
+
+    def record(self, gap: float, skipped: int):
+        self.runs += 1
+        self.total_gap += gap
+        self.max_gap = max(self.max_gap, gap)
+        if skipped > 0:
+            self.late += 1
+            self.missed += skipped
+
+    def summary(self) -> str:
+        mean = self.total_gap / self.runs * 1000 if self.runs else 0
+        return (
+            f"mean {mean:.1f}ms  max {self.max_gap*1000:.1f}ms  "
+            f"late {self.late}/{self.runs}  missed frames {self.missed}"
+        )
+
+
+@dataclass
+class Effect:
+    function: Callable
+    kwargs: Dict
+    every: int # Frames between calls
+    due: int # Next frame to be called on
+    catch_up: bool # Scale numeric kwargs by the number of periods elapsed
+    stats: TickStats
+    last_frame: int = None
+    last_time: float = None
+    # While set, the effect is suspended until this returns True
+    wake: Callable = None
+
+    def run(self, frame: int):
+        now = time.perf_counter()
+        kwargs = self.kwargs
+
+        if self.last_frame is not None:
+            elapsed = frame - self.last_frame
+            self.stats.record(now - self.last_time, elapsed - self.every)
+            if self.catch_up and elapsed > self.every:
+                kwargs = scale_kwargs(kwargs, elapsed / self.every)
+
+        self.last_frame = frame
+        self.last_time = now
+        self.due = frame + self.every
+        self.function(**kwargs)
+
+
+def scale_kwargs(kwargs: Dict, scale: float) -> Dict:
+    return {
+        key: value * scale if type(value) in (int, float) else value
+        for key, value in kwargs.items()
+    }
+
 
 class Job:
+    # One-shot jobs, keyed by name. Values are Scheduler ids
     jobs = {}
 
+    # Per-frame effects, keyed by name. All of them are run by a single frame
+    # loop, in the order they were added
+    effects: Dict[str, Effect] = {}
+
+    # TickStats of every per-frame job that has run, keyed by name. These are
+    # kept across restarts of the job
+    stats: Dict[str, TickStats] = {}
+
+    # Called at the start of every frame, before any effects (e.g. to act on
+    # debounced noises, so that the jobs they start run on the same frame)
+    input_hooks = {}
+
+    # Called after all effects on every frame (e.g. to commit the gamepad report)
+    frame_hooks = {}
+
+    # Name of the per-frame effect being run, if any
+    current: str = None
+
     @classmethod
-    def interval(cls, name: str, function: Callable, kwargs: Dict={}, interval: str="34ms"):
-        if name in cls.jobs:
+    def interval(
+        cls,
+        name: str,
+        function: Callable,
+        kwargs: Dict={},
+        frames: int=1,
+        catch_up: bool=False,
+        delay: int=0,
+    ):
+        """Call function every `frames` frames until cancelled, first in `delay` frames
+
+        If catch_up is True and the frame clock stalls past one or more calls,
+        the next call has its numeric kwargs scaled by the number of periods
+        elapsed, so e.g. a rotation keeps its rate regardless of stalls.
+        """
+        if name in cls.effects:
             cls.cancel(name)
 
-        routine = lambda: function(**kwargs)
-        cls.jobs[name] = cron.interval(interval, routine)
+        if name not in cls.stats:
+            cls.stats[name] = TickStats()
+
+        cls.effects[name] = Effect(
+            function = function,
+            kwargs = kwargs,
+            every = frames,
+            due = Scheduler.next_frame() + delay,
+            catch_up = catch_up,
+            stats = cls.stats[name],
+        )
+        cls.start_loop()
 
     @classmethod
-    def after(cls, name: str, function: Callable, kwargs: Dict={}, duration: str="34ms"):
+    def after(cls, name: str, function: Callable, kwargs: Dict={}, frames: int=1):
         if name in cls.jobs:
             cls.cancel(name)
 
-        after_fn = lambda: function(**kwargs)
-        cls.jobs[name] = cron.after(duration, after_fn)
+        cls.jobs[name] = Scheduler.after(
+            frames,
+            cls._run_after,
+            dict(name=name, function=function, kwargs=kwargs),
+        )
 
     @classmethod
     def cancel(cls, name):
-        assert name in cls.jobs, f"'{name}' is not an active CRON job name."
-        job = cls.jobs.pop(name) 
-        cron.cancel(job)
+        if name in cls.effects:
+            del cls.effects[name]
+            return
+
+        assert name in cls.jobs, f"'{name}' is not an active job name."
+        Scheduler.cancel(cls.jobs.pop(name))
+
+    @classmethod
+    def suspend(cls, wake: Callable):
+        """Stop calling the running per-frame effect until wake() returns True
+
+        wake is checked on each frame the effect would have run on. A suspended
+        effect is still active, and is cancelled and replaced as usual. It
+        resumes without catching up on the frames it was suspended for.
+        """
+        effect = cls.effects[cls.current]
+        effect.wake = wake
+        effect.last_frame = None
+
+    @classmethod
+    def active(cls, name: str) -> bool:
+        return name in cls.effects or name in cls.jobs
+
+    @classmethod
+    def jitter_summary(cls) -> str:
+        return "\n".join(f"{name:>14}: {stats.summary()}" for name, stats in cls.stats.items())
+
+    @classmethod
+    def start_loop(cls):
+        if "jobs" not in FrameClock.listeners:
+            FrameClock.listeners["jobs"] = cls._tick
+        FrameClock.run()
+
+    @classmethod
+    def _run_after(cls, name: str, function: Callable, kwargs: Dict):
+        del cls.jobs[name]
+        function(**kwargs)
+
+    @classmethod
+    def _tick(cls):
+        frame = FrameClock.frame
+
+        Scheduler.run(frame)
+
+        for hook in cls.input_hooks.values():
+            hook()
+
+        # Effects may start or cancel jobs, so iterate over a snapshot and
+        # skip any that have been cancelled or replaced in the meantime
+        for name, effect in list(cls.effects.items()):
+            if frame >= effect.due and cls.effects.get(name) is effect:
+                if effect.wake is not None:
+                    if not effect.wake():
+                        continue
+                    effect.wake = None
+
+                cls.current = name
+                effect.run(frame)
+                cls.current = None
+
+        for hook in cls.frame_hooks.values():
+            hook()
+
+
+class Scheduler:
+    """Runs one-shot callbacks a number of frames from now, without blocking
+
+    Calls are anonymous and never replace each other, so any number of them
+    (e.g. the releases of overlapping button presses) can be pending at once.
+    They are run at the start of the frame they are due on, before any
+    per-frame effects.
+    """
+    # Heap of (due frame, id)
+    queue = []
+    # Maps id to (function, kwargs) for every call that has not run or been cancelled
+    pending = {}
+    counter = itertools.count()
+
+    @classmethod
+    def after(cls, frames: int, function: Callable, kwargs: Dict={}) -> int:
+        call_id = next(cls.counter)
+        heapq.heappush(cls.queue, (cls.next_frame() + frames, call_id))
+        cls.pending[call_id] = (function, kwargs)
+        Job.start_loop()
+        return call_id
+
+    @classmethod
+    def cancel(cls, call_id: int):
+        cls.pending.pop(call_id, None)
+
+    @classmethod
+    def next_frame(cls) -> int:
+        """The first frame whose report can still include a change made now"""
+        return FrameClock.frame if FrameClock.ticking else FrameClock.frame + 1
+
+    @classmethod
+    def run(cls, frame: int):
+        while cls.queue and cls.queue[0][0] <= frame:
+            _, call_id = heapq.heappop(cls.queue)
+            if call_id in cls.pending:
+                function, kwargs = cls.pending.pop(call_id)
+                function(**kwargs)
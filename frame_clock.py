@@ -0,0 +1,82 @@
+from talon import cron
+
+import math
+import time
+
+# SM64 polls the controller once per game frame, at 30 frames per second
+FRAME_PERIOD: float = 1/30
+
+class FrameClock:
+    """A monotonic clock that calls its listeners once per emulator frame
+
+    Frame n is due at start + n * period, measured with time.perf_counter. After
+    each frame the cron timer is armed for whatever time remains until the next
+    deadline, so timer slop is corrected on the following frame instead of
+    accumulating over long inputs. If the thread is stalled past one or more
+    deadlines, those frames are skipped (and counted in `missed`) rather than
+    being run in a burst.
+    """
+    period: float = FRAME_PERIOD
+    start: float = None
+    frame: int = 0
+    missed: int = 0
+    ticking: bool = False
+    timer = None
+
+    # Called in insertion order on every frame
+    listeners = {}
+
+    @classmethod
+    def run(cls):
+        if cls.timer is not None:
+            return
+
+        cls.start = time.perf_counter() - cls.frame * cls.period
+        cls._arm()
+
+    @classmethod
+    def stop(cls):
+        if cls.timer is not None:
+            cron.cancel(cls.timer)
+            cls.timer = None
+
+    @classmethod
+    def set_period(cls, period: float):
+        """Change the frame period (in seconds) without changing the frame count"""
+        cls.period = period
+        if cls.timer is not None:
+            cls.stop()
+            cls.run()
+
+    @classmethod
+    def to_frames(cls, ms: float) -> int:
+        """The number of whole frames (at least 1) that best approximates ms"""
+        return max(1, round(ms / 1000 / cls.period))
+
+    @classmethod
+    def _arm(cls):
+        deadline = cls.start + (cls.frame + 1) * cls.period
+        delay = max(0, math.ceil((deadline - time.perf_counter()) * 1000))
+        cls.timer = cron.after(f"{delay}ms", cls._tick)
+
+    @classmethod
+    def _tick(cls):
+        frame = int((time.perf_counter() - cls.start) / cls.period)
+
+        # The timer can fire a little early, in which case this frame is not due yet
+        if frame <= cls.frame:
+            cls._arm()
+            return
+
+        cls.missed += frame - cls.frame - 1
+        cls.frame = frame
+
+        # Arm first, so the next deadline holds even if a listener raises
+        cls._arm()
+
+        cls.ticking = True
+        try:
+            for listener in list(cls.listeners.values()):
+                listener()
+        finally:
+            cls.ticking = False
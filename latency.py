@@ -0,0 +1,141 @@
+import time
+
+from typing import Dict, List
+
+# Histogram bucket width and count, in milliseconds. Latencies past the last
+# bucket are counted in it
+BUCKET_MS: float = 1
+BUCKETS: int = 1000
+
+# The stages a continuous noise passes through on its way to the gamepad
+STAGES = ("received", "resolved", "action", "report")
+
+# The gaps between consecutive stages, then the whole path
+SEGMENTS = tuple(f"{a}->{b}" for a, b in zip(STAGES, STAGES[1:])) + ("total",)
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.total = 0
+
+    def add(self, ms: float):
+        self.counts[min(int(ms / BUCKET_MS), BUCKETS - 1)] += 1
+        self.total += 1
+
+    def percentile(self, p: float) -> float:
+        """Upper edge (in ms) of the bucket holding the p-th percentile"""
+        target = p / 100 * self.total
+        running = 0
+        for i, count in enumerate(self.counts):
+            running += count
+            if running >= target:
+                return (i + 1) * BUCKET_MS
+        return BUCKETS * BUCKET_MS
+
+
+class Latency:
+    """End-to-end latency from a noise event to the gamepad report it causes
+
+    A trace is started when a noise edge is received, and timestamped when the
+    debouncer resolves it, when its action is entered, and when the next report
+    is sent to the driver. Completed traces are added to per-action histograms
+    of each stage-to-stage gap and of the total.
+
+    An action that changes nothing the gamepad reports (e.g. speeding up when
+    already at full speed) sends no report. Its trace is closed at the end of
+    the frame it ran in, and counted in `unreported` instead of waiting on
+    an unrelated later report.
+    """
+    enabled: bool = True
+
+    # Maps noise name to the timestamps of its open trace
+    traces: Dict[str, List[float]] = {}
+
+    # Noise whose resolved callback is running, i.e. whose action comes next
+    resolving: str = None
+
+    # (action, timestamps) for traces waiting on the next report
+    awaiting = []
+
+    # Maps (action, segment) to Histogram
+    histograms: Dict[tuple, Histogram] = {}
+
+    # Maps action to the number of its traces that sent no report
+    unreported: Dict[str, int] = {}
+
+    @classmethod
+    def received(cls, noise: str):
+        if cls.enabled:
+            cls.traces[noise] = [time.perf_counter()]
+
+    @classmethod
+    def resolved(cls, noise: str):
+        if noise in cls.traces:
+            cls.traces[noise].append(time.perf_counter())
+            cls.resolving = noise
+
+    @classmethod
+    def action(cls, action: str):
+        if cls.resolving is None:
+            return
+
+        trace = cls.traces.pop(cls.resolving)
+        trace.append(time.perf_counter())
+        cls.awaiting.append((action, trace))
+        cls.resolving = None
+
+    @classmethod
+    def reported(cls):
+        if not cls.awaiting:
+            return
+
+        now = time.perf_counter()
+        for action, trace in cls.awaiting:
+            trace.append(now)
+            for i, segment in enumerate(SEGMENTS[:-1]):
+                cls._add(action, segment, trace[i+1] - trace[i])
+            cls._add(action, "total", trace[-1] - trace[0])
+
+        cls.awaiting.clear()
+
+    @classmethod
+    def frame_end(cls):
+        """Close the traces whose action sent no report this frame. Runs after the commit"""
+        if not cls.awaiting:
+            return
+
+        for action, trace in cls.awaiting:
+            for i, segment in enumerate(SEGMENTS[:len(trace)-1]):
+                cls._add(action, segment, trace[i+1] - trace[i])
+            cls.unreported[action] = cls.unreported.get(action, 0) + 1
+
+        cls.awaiting.clear()
+
+    @classmethod
+    def summary(cls) -> str:
+        lines = []
+        order = lambda item: (item[0][0], SEGMENTS.index(item[0][1]))
+        for (action, segment), histogram in sorted(cls.histograms.items(), key=order):
+            p50, p95, p99 = (histogram.percentile(p) for p in (50, 95, 99))
+            lines.append(
+                f"{action:>14} {segment:>18}: "
+                f"p50 {p50:.0f}ms  p95 {p95:.0f}ms  p99 {p99:.0f}ms  (n={histogram.total})"
+            )
+        for action, count in sorted(cls.unreported.items()):
+            lines.append(f"{action:>14} {'no report':>18}: n={count}")
+        return "\n".join(lines)
+
+    @classmethod
+    def reset(cls):
+        cls.traces.clear()
+        cls.awaiting.clear()
+        cls.histograms.clear()
+        cls.unreported.clear()
+        cls.resolving = None
+
+    @classmethod
+    def _add(cls, action: str, segment: str, seconds: float):
+        key = (action, segment)
+        if key not in cls.histograms:
+            cls.histograms[key] = Histogram()
+        cls.histograms[key].add(seconds * 1000)
@@ -1,47 +1,98 @@
-import datetime
-import numpy as np
+import random
+import time
 
+from array import array
+from collections import deque
 from typing import List, Dict
 from dataclasses import dataclass
 
 from talon import actions
 
+@dataclass(frozen=True)
+class Event:
+    __slots__ = ("time", "action", "noise")
+    time: float
+    action: str
+    noise: str
+
+
 class Logger:
-    def __init__(self, cache_size: int=30):
+    """Fixed-capacity ring buffer of (time, action, noise) events
+
+    Events are stored column-wise in preallocated arrays: monotonic timestamps,
+    action names interned as integer ids, and noise labels. Labels include
+    chat authors, so they are kept by reference in a ring of their own rather
+    than interned, and only the last cache_size of them are held. Adding an
+    event overwrites the oldest slot, so it costs the same regardless of
+    cache_size.
+
+    Reports are not sent to the HUD right away. They are queued and sent in
+    batches by flush(), which should be run periodically off the input path.
+    """
+    def __init__(self, cache_size: int=1000):
         self.cache_size = cache_size
-        self.events: List[Dict] = [self.null()]
+        self.times = array('d', [0.0]) * cache_size
+        self.actions = array('l', [0]) * cache_size
+        self.noises: List[str] = [None] * cache_size
+
+        # Action names. Id 0 is reserved for None
+        self.names: List[str] = [None]
+        self.ids: Dict[str, int] = {None: 0}
+
+        self.head = 0 # Slot that the next event is written to
+        self.count = 0
 
-    def last_n(self, n):
-        return self.events[-n:]
+        # (action, noise) reports waiting for the next flush
+        self.pending = deque()
 
-    def null(self):
-        return dict(
-            time = datetime.datetime.now(),
-            action = None,
-            noise = None,
-        )
+        self._write(time.monotonic(), 0, None)
+
+    def last_n(self, n) -> List[Event]:
+        n = min(n, self.count)
+        slots = ((self.head - n + i) % self.cache_size for i in range(n))
+        return [
+            Event(self.times[i], self.names[self.actions[i]], self.noises[i])
+            for i in slots
+        ]
+
+    def intern(self, name: str) -> int:
+        if name not in self.ids:
+            self.ids[name] = len(self.names)
+            self.names.append(name)
+        return self.ids[name]
 
     def add(self, action, noise):
-        event = dict(
-            time = datetime.datetime.now(),
-            action = action,
-            noise = noise,
-        )
+        now = time.monotonic()
+        action_id = self.intern(action)
 
         # Decide whether to report
-        if event['action'] == self.events[-1]['action']:
+        last = (self.head - 1) % self.cache_size
+        if action_id == self.actions[last]:
             # This action was reported last. Check if recently
-            dt = (event['time'] - self.events[-1]['time']).total_seconds()
-            if dt > 0.2:
+            if now - self.times[last] > 0.2:
                 self.report(action, noise)
-        else:        
+        else:
             self.report(action, noise)
 
-        self.events.append(event)
-        if len(self.events) > self.cache_size:
-            self.events = self.events[1:]
-        
+        self._write(now, action_id, noise)
+
     def report(self, action, noise):
-        if np.random.randint(100) == 1:
+        if random.randrange(100) == 1:
             action, noise = "Follow channel", "pls"
-        actions.user.noise_log(action, noise)
+        self.pending.append((action, noise))
+
+    def flush(self):
+        """Send queued reports to the HUD, merging identical consecutive ones"""
+        last = None
+        while self.pending:
+            entry = self.pending.popleft()
+            if entry != last:
+                actions.user.noise_log(*entry)
+            last = entry
+
+    def _write(self, when: float, action_id: int, noise: str):
+        self.times[self.head] = when
+        self.actions[self.head] = action_id
+        self.noises[self.head] = noise
+        self.head = (self.head + 1) % self.cache_size
+        self.count = min(self.count + 1, self.cache_size)
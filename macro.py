@@ -0,0 +1,53 @@
+from typing import Callable, Dict, List, Tuple
+
+from .cron_jobs import Job, Scheduler
+from .frame_clock import FrameClock
+
+class Macro:
+    """A timeline of controller events, played back by the frame loop
+
+    Steps are declared as (frame, function, kwargs), with frames counted from
+    the frame the macro is started on. They are compiled once into arrays
+    sorted by frame. While running, the macro is a per-frame job that
+    dispatches the steps that have come due, so it never blocks other input
+    and can be cancelled partway through.
+    """
+    def __init__(self, name: str, steps: List[Tuple[int, Callable, Dict]]):
+        steps = sorted(steps, key=lambda step: step[0])
+
+        self.name = name
+        self.frames = [frame for frame, _, _ in steps]
+        self.functions = [function for _, function, _ in steps]
+        self.kwargs = [kwargs for _, _, kwargs in steps]
+
+        self.start = 0
+        self.index = 0
+
+    @property
+    def job_name(self) -> str:
+        return f"macro_{self.name}"
+
+    @property
+    def running(self) -> bool:
+        return self.job_name in Job.effects
+
+    def run(self):
+        """Play from the first step. Restarts the macro if it is already running"""
+        self.start = Scheduler.next_frame()
+        self.index = 0
+        Job.interval(name=self.job_name, function=self._step)
+
+    def cancel(self):
+        """Stop before the remaining steps are dispatched"""
+        if self.running:
+            Job.cancel(self.job_name)
+
+    def _step(self):
+        elapsed = FrameClock.frame - self.start
+
+        while self.index < len(self.frames) and self.frames[self.index] <= elapsed:
+            self.functions[self.index](**self.kwargs[self.index])
+            self.index += 1
+
+        if self.index == len(self.frames):
+            self.cancel()
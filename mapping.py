@@ -1,16 +1,24 @@
-from talon import Module, Context, cron, actions
+from talon import Module, Context, actions
 from dataclasses import dataclass
 
 from .logger import Logger
 from .state import GameState, MarioState
-from .controller import Controller, key_hold
+from .controller import Controller
 from .cron_jobs import Job
-from .chat import process_new_messages, clear_old_messages, ChatHack
+from .frame_clock import FrameClock
+from .debounce import Debouncer
+from .macro import Macro
+from .latency import Latency
+from .recorder import Recorder
+from .movie import MovieCapture
+from .trajectory import Trajectory
+from .chat import process_new_messages, process_votes, ChatHack, VOTE_WINDOW_FRAMES
 
 import math
 import time
 
-sleep = lambda ms: time.sleep(ms/1000)
+from functools import partial
+from pathlib import Path
 
 # -------------------------------------------------------
 # Tunables {{{
@@ -39,6 +47,45 @@ MARCH_SPEED_1 = 0.5
 # also defines the upper limit when doing on-the-fly whistling
 MARCH_SPEED_2 = 1.0
 
+# When enabled, every button, trigger and analog stick change made
+# within a frame is sent to the gamepad driver as one report holding
+# the final state, rather than one report per change
+COMMIT_PER_FRAME = True
+
+# Number of frames between sending queued log entries to the HUD
+LOG_FLUSH_FRAMES = 3
+
+# Number of whole frames a continuous noise must persist (or stay
+# silent) before its start (or stop) is acted on, so it is acted on
+# between this many frames and one more after the edge. Short windows
+# respond faster, long windows reject more misclassified noises
+DEBOUNCE_FRAMES = dict(
+    whis_hi = 2,
+    whis_lo = 2,
+    ll = 1,
+    rr = 1,
+)
+
+# Continuous noises whose start is acted on immediately instead of
+# after their debounce window. If the noise stops within the window,
+# Mario's state and the analog stick are rolled back to where they were.
+# Off by default; e.g. ["whis_hi", "whis_lo"] saves the whistles' window
+SPECULATIVE_NOISES = []
+
+# When enabled, the whole path of a sustained stick effect (whistles,
+# ll and rr) is computed when it starts, and each frame just looks up
+# the next position, so long inputs do not accumulate rounding error
+STICK_TRAJECTORIES = True
+
+# How sustained stick effects get up to speed when STICK_TRAJECTORIES
+# is enabled. "linear" moves at full rate from the first frame, while
+# "ease_in" and "smooth" ramp up over a few frames
+STICK_EASING = "linear"
+
+# Where noise traces and .m64 movies are written by the "record noises"
+# and "capture movie" commands
+RECORDINGS_DIR = Path(__file__).parent / "recordings"
+
 # -------------------------------------------------------
 # }}}
 # -------------------------------------------------------
@@ -46,8 +93,21 @@ MARCH_SPEED_2 = 1.0
 mod = Module()
 log = Logger()
 
-state = {}
-cron_jobs = {}
+Controller.set_commit_mode(COMMIT_PER_FRAME)
+
+# HUD rendering is kept off the input path. Actions only queue log
+# entries, and they are sent to the HUD in batches once the frame's
+# report is committed (frame hooks run in the order they are added)
+def _flush_log():
+    if FrameClock.frame % LOG_FLUSH_FRAMES == 0:
+        log.flush()
+
+Job.frame_hooks["log_flush"] = _flush_log
+
+# Latency traces whose action sent no report are closed once the frame's
+# report is committed, rather than left for an unrelated later one
+Job.frame_hooks["latency"] = Latency.frame_end
+
 callbacks = {}
 
 ctx = Context()
@@ -72,76 +132,185 @@ def value_from_signal(signal: float, lower: float, upper: float, min_value: int,
     return frames
 
 
-def _bounded_alter_polar(**kwargs):
-    """A small wrapper of Controller.LJoy.alter_polar"""
-    Controller.LJoy.alter_polar(**kwargs)
-    if Controller.LJoy.val > MARCH_SPEED_2:
-        Controller.LJoy.val = MARCH_SPEED_2
-    if Controller.LJoy.val < MARCH_SPEED_1:
-        Controller.LJoy.val = MARCH_SPEED_1
-    
+def _snapshot():
+    """Capture everything a continuous noise's start action can change"""
+    return dict(
+        marching = MarioState.marching,
+        direction = MarioState.direction,
+        cached_speed = MarioState.cached_speed,
+        val = Controller.LJoy.val,
+        angle = Controller.LJoy.angle,
+        active = Controller.LJoy.active,
+    )
+
+
+def _rollback(snapshot, started):
+    """Undo a speculatively started noise, restoring a _snapshot
+
+    Only the effects the noise's start added are cancelled, and those it
+    replaced are put back, so effects started since by other noises are kept.
+    """
+    for name, (replaced, added) in started.items():
+        if Job.effects.get(name) is not added:
+            continue
+        if replaced is not None:
+            Job.effects[name] = replaced
+        else:
+            Job.cancel(name)
+
+    MarioState.marching = snapshot["marching"]
+    MarioState.direction = snapshot["direction"]
+    MarioState.cached_speed = snapshot["cached_speed"]
+
+    if snapshot["active"]:
+        Controller.LJoy.set_polar(val=snapshot["val"], angle=snapshot["angle"])
+    else:
+        Controller.LJoy.release()
+        Controller.LJoy.angle = snapshot["angle"]
+
+
+def _saturating(**deltas):
+    """Contribute to Controller.LJoy, suspending the job while the stick is saturated
+
+    Once the deltas would no longer move the stick (e.g. at full speed, or on
+    the edge of the unit circle), the job stops ticking until something
+    else moves the stick off that bound.
+    """
+    stick = Controller.LJoy
+    if stick.saturated(**deltas):
+        Job.suspend(wake=lambda: not stick.saturated(**deltas))
+    else:
+        stick.contribute(**deltas)
+
+
+def _sustain(name: str, min_val: float = 0, max_val: float = 1, **deltas):
+    """Apply deltas to Controller.LJoy every frame, as the per-frame job `name`"""
+    if STICK_TRAJECTORIES:
+        trajectory = Trajectory(
+            Controller.LJoy,
+            min_val = min_val,
+            max_val = max_val,
+            easing = STICK_EASING,
+            **deltas,
+        )
+        Job.interval(name=name, function=trajectory.tick)
+    else:
+        # Bounds are bound here, so catching up only scales the deltas
+        Job.interval(
+            name = name,
+            function = partial(_saturating, min_val=min_val, max_val=max_val),
+            kwargs = deltas,
+            catch_up = True,
+        )
+
+
+def _toggle_camera():
+    Controller.RBump.press(frames=2)
+    Controller.LJoy.angle = 90
+
+
+def _straighten():
+    MarioState.direction = 90
+    Controller.LJoy.set_polar(
+        val=Controller.LJoy.val,
+        angle=90,
+    )
+
+
+exit_lock_macro = Macro("exit_lock", [
+    # toggle camera (into lakitu)
+    (0, _toggle_camera, {}),
+
+    # straighten
+    (2, _straighten, {}),
+
+    # outy
+    (2, Controller.RJoy.set_cartesian, dict(x=0, y=-1)),
+    (8, Controller.RJoy.set_cartesian, dict(x=0, y=0)),
+
+    # let camera equilibrate, then inch forward
+    (14, Controller.LJoy.set_cartesian, dict(x=0, y=0.5)),
+    (20, Controller.LJoy.set_cartesian, dict(x=0, y=0)),
+
+    # toggle camera (into mario)
+    (20, _toggle_camera, {}),
+])
+
+
+def _listen_to_chat():
+    """Dispatch queued chat messages, and report connection failures"""
+    if ChatHack.error is not None:
+        # The reader reconnects by itself
+        log.add("ChatHack reconnecting", "chatty")
+        ChatHack.error = None
+
+    process_new_messages()
+
 
 @ctx.action_class("user")
 class JoyStickActions:
     def march_slow(name: str):
         if not MarioState.marching:
-            log.add("Walk", name)
             Controller.LJoy.set_polar(val=MARCH_SPEED_1, angle=MarioState.direction)
+            log.add("Walk", name)
         else:
-            log.add("Stop", name)
             MarioState.direction = Controller.LJoy.angle
             Controller.LJoy.release()
+            log.add("Stop", name)
 
         MarioState.marching = not MarioState.marching
             
     def march_fast(name: str):
         if not MarioState.marching:
-            log.add("Run", name)
             Controller.LJoy.set_polar(val=MARCH_SPEED_2, angle=MarioState.direction)
+            log.add("Run", name)
         else:
-            log.add("Stop", name)
             MarioState.direction = Controller.LJoy.angle
             Controller.LJoy.release()
+            log.add("Stop", name)
 
         MarioState.marching = not MarioState.marching
             
     def whis_hi_start(name: str):
+        Latency.action("whis_hi_start")
         if MarioState.marching:
             # Mario is moving at some speed. Increase that speed
             log.add("Speed up", name)
-            Job.interval(
+            _sustain(
                 name = "speed_up",
-                function = _bounded_alter_polar,
-                kwargs = dict(dr=DELTA_SPEED),
+                dr = DELTA_SPEED,
+                min_val = MARCH_SPEED_1,
+                max_val = MARCH_SPEED_2,
             )
         else:
             # Mario is not moving. Whistling controls Y-axis
             log.add("Pulse up", name)
-            Job.interval(
+            _sustain(
                 name = "joy_up",
-                function = Controller.LJoy.alter_cartesian,
-                kwargs = dict(dy=DELTA_XY),
+                dy = DELTA_XY,
             )
             
     def whis_lo_start(name: str):
+        Latency.action("whis_lo_start")
         if MarioState.marching:
             # Mario is moving at some speed. Decrease that speed
             log.add("Slow down", name)
-            Job.interval(
+            _sustain(
                 name = "slow_down",
-                function = _bounded_alter_polar,
-                kwargs = dict(dr=-DELTA_SPEED),
+                dr = -DELTA_SPEED,
+                min_val = MARCH_SPEED_1,
+                max_val = MARCH_SPEED_2,
             )
         else:
             # Mario is not moving. Whistling controls Y-axis
             log.add("Pulse down", name)
-            Job.interval(
+            _sustain(
                 name = "joy_down",
-                function = Controller.LJoy.alter_cartesian,
-                kwargs = dict(dy=-DELTA_XY),
+                dy = -DELTA_XY,
             )
 
     def ll_start(name: str):
+        Latency.action("ll_start")
         log.add("Pulse left", name)
 
         if MarioState.marching:
@@ -150,19 +319,18 @@ class JoyStickActions:
             MarioState.direction = Controller.LJoy.angle
             MarioState.cached_speed = Controller.LJoy.val
 
-            Job.interval(
+            _sustain(
                 name = "joy_left",
-                function = Controller.LJoy.alter_polar,
-                kwargs = dict(dtheta=+DELTA_THETA),
+                dtheta = +DELTA_THETA,
             )
         else:
-            Job.interval(
+            _sustain(
                 name = "joy_left",
-                function = Controller.LJoy.alter_cartesian,
-                kwargs = dict(dx=-DELTA_XY),
+                dx = -DELTA_XY,
             )
 
     def rr_start(name: str):
+        Latency.action("rr_start")
         log.add("Pulse right", name)
 
         # Store the current analog stick information, because after the
@@ -171,19 +339,18 @@ class JoyStickActions:
         MarioState.cached_speed = Controller.LJoy.val
 
         if MarioState.marching:
-            Job.interval(
+            _sustain(
                 name = "joy_right",
-                function = Controller.LJoy.alter_polar,
-                kwargs = dict(dtheta=-DELTA_THETA),
+                dtheta = -DELTA_THETA,
             )
         else:
-            Job.interval(
+            _sustain(
                 name = "joy_right",
-                function = Controller.LJoy.alter_cartesian,
-                kwargs = dict(dx=+DELTA_XY),
+                dx = +DELTA_XY,
             )
 
     def whis_hi_stop():
+        Latency.action("whis_hi_stop")
         if MarioState.marching:
             Job.cancel("speed_up")
         else:
@@ -194,6 +361,7 @@ class JoyStickActions:
                 MarioState.direction = 90
 
     def whis_lo_stop():
+        Latency.action("whis_lo_stop")
         if MarioState.marching:
             Job.cancel("slow_down")
             return
@@ -213,6 +381,7 @@ class JoyStickActions:
             Controller.LJoy.release()
 
     def ll_stop():
+        Latency.action("ll_stop")
         if not MarioState.marching:
             # Set mario's direction where he is looking
             MarioState.direction = Controller.LJoy.angle
@@ -227,6 +396,7 @@ class JoyStickActions:
         )
 
     def rr_stop():
+        Latency.action("rr_stop")
         if not MarioState.marching:
             # Set mario's direction where he is looking
             MarioState.direction = Controller.LJoy.angle
@@ -241,24 +411,24 @@ class JoyStickActions:
         )
 
     def joystick_cw(name: str):
-        log.add("Rotate right", name)
         Controller.LJoy.alter_polar(dtheta=-DELTA_THETA)
+        log.add("Rotate right", name)
         
     def joystick_ccw(name: str):
-        log.add("Rotate left", name)
         Controller.LJoy.alter_polar(dtheta=DELTA_THETA)
+        log.add("Rotate left", name)
 
     def joystick_forward(name: str):
-        log.add("Straighten", name)
         MarioState.direction = 90
         Controller.LJoy.set_polar(
             val=Controller.LJoy.val,
             angle=90,
         )
+        log.add("Straighten", name)
 
     def joystick_invert(name: str):
-        log.add("Invert", name)
         Controller.LJoy.alter_polar(dtheta=180)
+        log.add("Invert", name)
         
 
 @ctx.action_class("user")
@@ -268,105 +438,79 @@ class GeneralActions:
         log.add("Nothing", name)
 
     def single_jump(name: str):
-        log.add("Jump", name)
         Controller.A.press(frames=10)
+        log.add("Jump", name)
 
     def punch(name: str):
         if name == "ho" and "pound" in Job.jobs:
             # Ya-ho is often interpreted instead of
             # ya-hoo, which is almost always the intent
-            log.add("Jump", name)
             Controller.A.press(frames=10)
+            log.add("Jump", name)
 
-        log.add("Punch", name)
         Controller.X.press(frames=10)
+        log.add("Punch", name)
 
     def ground_pound(name: str):
-        log.add("Pound", name)
         Controller.LTrig.hold(val=1)
+        log.add("Pound", name)
         Job.after(
             name = "pound",
             function = Controller.LTrig.release,
-            duration = "500ms",
+            frames = 15,
         )
 
     def camera_toggle(name: str):
-        log.add("Camera", name)
         Controller.RBump.press(frames=2)
         Controller.LJoy.angle = 90
+        log.add("Camera", name)
         
     def camera_in(name: str):
-        log.add("Zoom in", name)
         Controller.RJoy.set_cartesian(x=0, y=1)
+        log.add("Zoom in", name)
         Job.after(
             name = "zoom_in",
             function = Controller.RJoy.set_cartesian,
             kwargs = dict(x=0, y=0),
-            duration = "200ms",
+            frames = 6,
         )
         
     def camera_out(name: str):
-        log.add("Zoom out", name)
         Controller.RJoy.set_cartesian(x=0, y=-1)
+        log.add("Zoom out", name)
         Job.after(
             name = "zoom_out",
             function = Controller.RJoy.set_cartesian,
             kwargs = dict(x=0, y=0),
-            duration = "200ms",
+            frames = 6,
         )
         
     def camera_left(name: str):
-        log.add("Cam left", name)
         Controller.RJoy.set_cartesian(x=-1, y=0)
+        log.add("Cam left", name)
         Job.after(
             name = "cam_left",
             function = Controller.RJoy.set_cartesian,
             kwargs = dict(x=0, y=0),
-            duration = "200ms",
+            frames = 6,
         )
         
     def camera_right(name: str):
-        log.add("Cam right", name)
         Controller.RJoy.set_cartesian(x=1, y=0)
+        log.add("Cam right", name)
         Job.after(
             name = "cam_right",
             function = Controller.RJoy.set_cartesian,
             kwargs = dict(x=0, y=0),
-            duration = "200ms",
+            frames = 6,
         )
         
     def exit_lock(name: str):
-        # toggle camera (into lakitu)
-        Controller.RBump.press(frames=2)
-        Controller.LJoy.angle = 90
+        exit_lock_macro.run()
 
-        # straighten
-        MarioState.direction = 90
-        Controller.LJoy.set_polar(
-            val=Controller.LJoy.val,
-            angle=90,
-        )
-
-        # outy
-        Controller.RJoy.set_cartesian(x=0, y=-1)
-        sleep(200)
-        Controller.RJoy.set_cartesian(x=0, y=0)
-
-        # let camera equilibrate
-        sleep(200)
-
-        # inch forward
-        Controller.LJoy.set_cartesian(x=0, y=0.5)
-        sleep(200)
-        Controller.LJoy.set_cartesian(x=0, y=0)
-
-        # toggle camera (into mario)
-        Controller.RBump.press(frames=2)
-        Controller.LJoy.angle = 90
-        
     def press_start(name: str):
-        log.add("Press start", name)
         Controller.Start.press()
+        log.add("Press start", name)
 
     def reset_state(name: str):
         """Call when mario is stationary, in normal lakitu camera mode"""
@@ -377,25 +521,35 @@ class GeneralActions:
         Controller.LJoy.set_cartesian(x=0, y=0)
 
     def toggle_chat_hack():
+        # The connection is kept open either way, and made on the reader thread
         if ChatHack.active:
             Job.cancel("chat_listen")
-            log.add("ChatHack disconnected", "chatty")
+            ChatHack.disable()
+            log.add("ChatHack paused", "chatty")
         else:
-            try:
-                ChatHack.reset()
-            except:
-                log.add("ChatHack failed", "chatty")
-                return
-
+            ChatHack.enable()
             log.add("ChatHack connected", "chatty")
-            clear_old_messages()
             Job.interval(
                 name = "chat_listen",
-                function = process_new_messages,
-                interval = "500ms",
+                function = _listen_to_chat,
             )
 
-        ChatHack.active = not ChatHack.active
+    def toggle_chat_voting():
+        if ChatHack.voting:
+            Job.cancel("chat_votes")
+            ChatHack.voting = False
+            log.add("Chat votes off", "votes")
+        else:
+            ChatHack.clear_votes()
+            ChatHack.voting = True
+            log.add("Chat votes on", "votes")
+            Job.interval(
+                name = "chat_votes",
+                function = process_votes,
+                frames = VOTE_WINDOW_FRAMES,
+                # The first window is a full one too
+                delay = VOTE_WINDOW_FRAMES,
+            )
 
 
 @mod.action_class
@@ -406,12 +560,46 @@ class Actions:
 
     def noise_debounce(name: str, active: bool):
         """Start or stop continuous noise using debounce"""
-        if name not in state:
-            state[name] = active
-            cron_jobs[name] = cron.after("60ms", lambda: callback(name))
-        elif state[name] != active:
-            cron.cancel(cron_jobs[name])
-            state.pop(name)
+        Recorder.record(name, int(active))
+        if name not in debouncer.pending:
+            # This edge is the one that will resolve, unless it is reversed
+            Latency.received(name)
+        debouncer.edge(name, bool(active))
+
+    def noise_record(noise: str, flag: int):
+        """Add a parrot noise event to the trace being recorded, if any"""
+        Recorder.record(noise, flag)
+
+    def toggle_noise_recording():
+        """Start or stop recording parrot noise events to a trace file"""
+        if Recorder.file is not None:
+            Recorder.stop()
+            log.add("Recording stopped", "record")
+        else:
+            Recorder.start(RECORDINGS_DIR / time.strftime("%Y%m%d-%H%M%S.noises"))
+            log.add("Recording noises", "record")
+
+    def toggle_movie_capture():
+        """Start capturing the controller state each frame, or stop and export it as an .m64 movie"""
+        if MovieCapture.capturing():
+            MovieCapture.stop()
+            MovieCapture.export(RECORDINGS_DIR / time.strftime("%Y%m%d-%H%M%S.m64"))
+            log.add("Movie saved", "capture")
+        else:
+            MovieCapture.start()
+            log.add("Capturing movie", "capture")
+
+    def latency_report():
+        """Print noise to gamepad latency percentiles for each action"""
+        print(Latency.summary())
+
+    def jitter_report():
+        """Print how regularly each per-frame job has been run"""
+        print(Job.jitter_summary())
+
+    def chat_report():
+        """Print how many chat commands have been dropped, and why"""
+        print(", ".join(f"{reason}: {count}" for reason, count in ChatHack.drops.items()))
 
     def whis_hi_start(name: str):""""""
     def whis_hi_stop():""""""
@@ -440,32 +628,32 @@ class Actions:
     def exit_lock(name: str):""""""
     def reset_state(name: str):""""""
     def toggle_chat_hack():""""""
-
-
-def callback(name: str):
-    active = state.pop(name)
-    callbacks[name](active)
+    def toggle_chat_voting():""""""
 
 
 def on_whis_hi(active: bool):
+    Latency.resolved("whis_hi")
     if active:
         actions.user.whis_hi_start("high whistle")
     else:
         actions.user.whis_hi_stop()
 
 def on_whis_lo(active: bool):
+    Latency.resolved("whis_lo")
     if active:
         actions.user.whis_lo_start("low whistle")
     else:
         actions.user.whis_lo_stop()
 
 def on_ll(active: bool):
+    Latency.resolved("ll")
     if active:
         actions.user.ll_start("ll")
     else:
         actions.user.ll_stop()
 
 def on_rr(active: bool):
+    Latency.resolved("rr")
     if active:
         actions.user.rr_start("rr")
     else:
@@ -475,3 +663,11 @@ callbacks["whis_hi"] = on_whis_hi
 callbacks["whis_lo"] = on_whis_lo
 callbacks["ll"] = on_ll
 callbacks["rr"] = on_rr
+
+debouncer = Debouncer(
+    callbacks = callbacks,
+    windows = DEBOUNCE_FRAMES,
+    speculative = SPECULATIVE_NOISES,
+    snapshot = _snapshot,
+    rollback = _rollback,
+)
@@ -0,0 +1,146 @@
+import struct
+import sys
+import time
+
+from array import array
+from pathlib import Path
+
+from .controller import Controller, STICK_MAX, COS, SIN
+from .cron_jobs import Job
+from .frame_clock import FrameClock
+
+# N64 controller bits of an .m64 input sample. The low 16 bits hold the
+# buttons, followed by the signed stick x and y bytes
+R_DPAD, L_DPAD, D_DPAD, U_DPAD = 0x0001, 0x0002, 0x0004, 0x0008
+START, Z_TRIG, B_BUTTON, A_BUTTON = 0x0010, 0x0020, 0x0040, 0x0080
+R_CBUTTON, L_CBUTTON, D_CBUTTON, U_CBUTTON = 0x0100, 0x0200, 0x0400, 0x0800
+R_TRIG, L_TRIG = 0x1000, 0x2000
+
+# How the virtual Xbox controller is mapped to the N64 controller by the
+# emulator's input plugin
+BUTTON_MAP = (
+    (Controller.A, A_BUTTON),
+    (Controller.X, B_BUTTON),
+    (Controller.Start, START),
+    (Controller.RBump, R_TRIG),
+    (Controller.LBump, L_TRIG),
+    (Controller.DRight, R_DPAD),
+    (Controller.DLeft, L_DPAD),
+    (Controller.DDown, D_DPAD),
+    (Controller.DUp, U_DPAD),
+)
+TRIGGER_MAP = (
+    (Controller.LTrig, Z_TRIG),
+)
+
+# Full deflection of the N64 analog stick, in .m64 units
+N64_STICK_MAX = 80
+
+# Fraction of full deflection at which the right stick presses a C button
+C_THRESHOLD = 0.5
+
+# About 4 hours at 30 samples per second (1.7 MB)
+CAPACITY = 30 * 60 * 60 * 4
+
+HEADER_SIZE = 0x400
+
+class MovieCapture:
+    """Captures the controller state once per frame, for export as an .m64 movie
+
+    Each frame is encoded into a single N64 input sample and stored in a
+    preallocated array, so capturing costs a handful of attribute reads per
+    frame. Frames skipped by the frame clock repeat the previous sample, so the
+    movie stays frame-indexed.
+    """
+    samples = array('I', [0]) * CAPACITY
+    count: int = 0
+    last_frame: int = None
+
+    @classmethod
+    def capturing(cls) -> bool:
+        return "capture" in Job.frame_hooks
+
+    @classmethod
+    def start(cls):
+        cls.count = 0
+        cls.last_frame = None
+        Job.frame_hooks["capture"] = cls.capture
+        Job.start_loop()
+
+    @classmethod
+    def stop(cls):
+        Job.frame_hooks.pop("capture", None)
+
+    @classmethod
+    def capture(cls):
+        frame = FrameClock.frame
+        sample = cls.encode()
+
+        # The controller held its previous state through skipped frames, and
+        # only changed to this one on the current frame
+        repeats = 1 if cls.last_frame is None else frame - cls.last_frame
+        previous = cls.samples[cls.count - 1] if cls.count else sample
+        for i in range(min(repeats, CAPACITY - cls.count)):
+            cls.samples[cls.count] = previous if i < repeats - 1 else sample
+            cls.count += 1
+
+        cls.last_frame = frame
+
+    @classmethod
+    def encode(cls) -> int:
+        buttons = 0
+        for button, bit in BUTTON_MAP:
+            if button.held:
+                buttons |= bit
+        for trigger, bit in TRIGGER_MAP:
+            if trigger.held:
+                buttons |= bit
+
+        right = Controller.RJoy
+        c_x = right.mag * COS[right.step] / STICK_MAX
+        c_y = right.mag * SIN[right.step] / STICK_MAX
+        if c_x > C_THRESHOLD: buttons |= R_CBUTTON
+        if c_x < -C_THRESHOLD: buttons |= L_CBUTTON
+        if c_y > C_THRESHOLD: buttons |= U_CBUTTON
+        if c_y < -C_THRESHOLD: buttons |= D_CBUTTON
+
+        left = Controller.LJoy
+        x = round(left.mag * COS[left.step] * N64_STICK_MAX / STICK_MAX)
+        y = round(left.mag * SIN[left.step] * N64_STICK_MAX / STICK_MAX)
+        return buttons | (x & 0xFF) << 16 | (y & 0xFF) << 24
+
+    @classmethod
+    def export(
+        cls,
+        path: Path,
+        author: str = "",
+        description: str = "",
+        power_on: bool = True,
+        rom_name: str = "SUPER MARIO 64",
+        rom_crc: int = 0x635A2BFF,
+        rom_country: int = 0x45,
+    ):
+        """Write the captured samples as a version 3 .m64 movie
+
+        The ROM fields default to SM64 (U), and emulators refuse to play movies
+        whose ROM does not match. A power-on movie only reproduces the session
+        if capture was started from a reset; otherwise set power_on to False
+        and provide the emulator with the savestate taken when capture started.
+        """
+        samples = cls.samples[:cls.count]
+        if sys.byteorder != "little":
+            samples.byteswap()
+
+        header = bytearray(HEADER_SIZE)
+        struct.pack_into("<4sIIII", header, 0x000, b"M64\x1a", 3, int(time.time()), 2 * cls.count, 0)
+        struct.pack_into("<BB", header, 0x014, 60, 1)
+        struct.pack_into("<IH", header, 0x018, cls.count, 2 if power_on else 1)
+        struct.pack_into("<I", header, 0x020, 0x1) # Controller 1 present
+        struct.pack_into("<32sIH", header, 0x0C4, rom_name.encode(), rom_crc, rom_country)
+        struct.pack_into("<222s256s", header, 0x222, author.encode(), description.encode())
+
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        with open(path, "wb") as file:
+            file.write(header)
+            file.write(samples.tobytes())
@@ -0,0 +1,72 @@
+import mmap
+import struct
+import time
+
+from pathlib import Path
+from typing import Iterator, NamedTuple
+
+# Trace files start with a header: magic, format version and record size
+HEADER = struct.Struct("<8sHH")
+MAGIC = b"SM64NOIS"
+VERSION = 1
+
+# Followed by fixed-size records: monotonic time, noise name (NUL padded),
+# flag, power and frequency
+RECORD = struct.Struct("<d16sBff")
+
+STOP, START, REPEAT = 0, 1, 2
+
+class NoiseEvent(NamedTuple):
+    time: float
+    noise: str
+    flag: int
+    power: float
+    frequency: float
+
+
+class Recorder:
+    """Appends every parrot noise event to a binary trace file
+
+    Each event costs one struct pack and one buffered write. Traces are
+    append-only with fixed-size records, so they can be memory-mapped and
+    replayed (see read_trace), including ones cut short by a crash.
+    """
+    file = None
+    path: Path = None
+
+    @classmethod
+    def start(cls, path: Path):
+        cls.stop()
+
+        path = Path(path)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        cls.file = open(path, "ab", buffering=1 << 16)
+        cls.path = path
+        if cls.file.tell() == 0:
+            cls.file.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+
+    @classmethod
+    def stop(cls):
+        if cls.file is not None:
+            cls.file.close()
+            cls.file = None
+
+    @classmethod
+    def record(cls, noise: str, flag: int, power: float=0, frequency: float=0):
+        if cls.file is not None:
+            cls.file.write(RECORD.pack(time.monotonic(), noise.encode(), flag, power, frequency))
+
+
+def read_trace(path: Path) -> Iterator[NoiseEvent]:
+    """Memory-map a trace file and iterate over its events"""
+    with open(path, "rb") as file:
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, version, size = HEADER.unpack_from(data)
+            if magic != MAGIC or version != VERSION or size != RECORD.size:
+                raise ValueError(f"{path} is not a version {VERSION} noise trace")
+
+            # Ignore a partially written final record
+            end = HEADER.size + (len(data) - HEADER.size) // size * size
+            for offset in range(HEADER.size, end, size):
+                when, noise, flag, power, frequency = RECORD.unpack_from(data, offset)
+                yield NoiseEvent(when, noise.rstrip(b"\0").decode(), flag, power, frequency)
@@ -0,0 +1,152 @@
+import math
+import numpy as np
+
+from .controller import JoyStick, STICK_MAX, ANGLE_STEP, ANGLE_STEPS, ANGLE_RAD, COS, SIN
+from .cron_jobs import Job
+from .frame_clock import FrameClock
+
+# Samples computed at a time. Effects held for longer have the next chunk
+# computed from where the last one ended
+CHUNK_FRAMES = 150
+
+# Frames the easing curves take to reach full rate
+EASE_FRAMES = 6
+
+def linear(frames: np.ndarray) -> np.ndarray:
+    """Full rate from the first frame"""
+    return np.ones(len(frames))
+
+def ease_in(frames: np.ndarray) -> np.ndarray:
+    """Rate rising linearly to full over EASE_FRAMES"""
+    return np.minimum((frames + 1) / EASE_FRAMES, 1)
+
+def smooth(frames: np.ndarray) -> np.ndarray:
+    """Rate rising along a smoothstep curve to full over EASE_FRAMES"""
+    t = np.minimum((frames + 1) / EASE_FRAMES, 1)
+    return t * t * (3 - 2 * t)
+
+# Fraction of its deltas an effect applies on each frame since it started
+EASINGS = dict(linear=linear, ease_in=ease_in, smooth=smooth)
+
+class Trajectory:
+    """A sustained stick effect, with its path precomputed from where it starts
+
+    The positions for the coming frames are computed in one vectorized pass
+    from the stick's state when the effect starts, so each tick is a lookup
+    and long effects do not accumulate rounding error. Effects are either
+    polar (dr, dtheta, with the magnitude kept within min_val and max_val) or
+    cartesian (dx, dy, clamped to the unit circle, along which the stick then
+    slides as it would when pushed frame by frame).
+
+    If the stick is moved by something else (e.g. a rotation while the
+    effect is held), the path is started again from where the stick is. Once
+    the path stops changing (e.g. at full speed) the job is suspended, and it
+    likewise starts again if the stick is then moved.
+    """
+    def __init__(
+        self,
+        stick: JoyStick,
+        dr: float = 0,
+        dtheta: float = 0,
+        dx: float = 0,
+        dy: float = 0,
+        min_val: float = 0,
+        max_val: float = 1,
+        easing: str = "linear",
+    ):
+        self.stick = stick
+        self.dr, self.dtheta = dr, dtheta
+        self.dx, self.dy = dx * STICK_MAX, dy * STICK_MAX
+        self.min_mag = stick._quantize_val(min_val)
+        self.max_mag = stick._quantize_val(max_val)
+        self.rate = EASINGS[easing]
+        self.origin: int = None # Frame of the first sample
+        self.suspended = False
+
+    def tick(self):
+        # Compared with where the last mix left the stick rather than with this
+        # path's own sample, as other effects mixed in move it off the path
+        moved = (self.stick.mag, self.stick.step) != self.stick.mixed
+        if self.origin is None or self.suspended or moved:
+            self._begin(FrameClock.frame)
+
+        i = FrameClock.frame - self.origin
+        if self.final is not None and i >= self.final:
+            i = self.final
+            target = (int(self.mags[i]), int(self.steps[i]))
+            self.suspended = True
+            Job.suspend(wake=lambda: (self.stick.mag, self.stick.step) != target)
+
+        while i >= len(self.mags):
+            self._extend()
+        last_mag, last_step = (self.mags[i-1], self.steps[i-1]) if i else self.start
+        self.stick.aim(int(self.mags[i]), int(self.steps[i]), int(last_mag), int(last_step))
+
+    def _begin(self, frame: int):
+        """Start the path from the stick's current state, with its first sample on frame"""
+        self.start = (self.stick.mag, self.stick.step)
+        self.origin = frame
+        self.progress = 0.0 # Deltas applied by the end of the computed samples
+        self.x = self.start[0] * COS[self.start[1]]
+        self.y = self.start[0] * SIN[self.start[1]]
+        self.on_rim = False
+        self.mags = np.empty(0, dtype=np.int64)
+        self.steps = np.empty(0, dtype=np.int64)
+        self.final: int = None # Sample from which the path no longer changes
+        self.suspended = False
+
+    def _extend(self):
+        n = len(self.mags)
+        weights = self.rate(np.arange(n, n + CHUNK_FRAMES, dtype=np.float64))
+
+        if self.dx or self.dy:
+            mags, steps = self._cartesian(weights)
+        else:
+            mags, steps = self._polar(weights)
+            if self.final is None and not self.dtheta:
+                bound = self.max_mag if self.dr > 0 else self.min_mag
+                saturated = np.flatnonzero(mags == bound)
+                if len(saturated):
+                    self.final = n + int(saturated[0])
+
+        self.mags = np.concatenate((self.mags, mags))
+        self.steps = np.concatenate((self.steps, steps))
+
+    def _polar(self, weights: np.ndarray):
+        progress = self.progress + np.cumsum(weights)
+        self.progress = progress[-1]
+
+        mag, step = self.start
+        mags = np.clip(mag + np.rint(progress * self.dr * STICK_MAX), self.min_mag, self.max_mag)
+        steps = (step + np.rint(progress * self.dtheta / ANGLE_STEP)) % ANGLE_STEPS
+        return mags.astype(np.int64), steps.astype(np.int64)
+
+    def _cartesian(self, weights: np.ndarray):
+        n = len(self.mags)
+        xs = self.x + np.cumsum(weights) * self.dx
+        ys = self.y + np.cumsum(weights) * self.dy
+
+        # Up to the unit circle the path is a straight line. Past it, each
+        # push is projected back onto the circle, so the stick slides around
+        # it until it points along the push
+        outside = np.hypot(xs, ys) > STICK_MAX
+        rim = 0 if self.on_rim else int(np.argmax(outside)) if outside.any() else len(weights)
+        end_step = round(math.atan2(self.dy, self.dx) / ANGLE_RAD) % ANGLE_STEPS
+        x, y = (xs[rim-1], ys[rim-1]) if rim else (self.x, self.y)
+        for k in range(rim, len(weights)):
+            x += weights[k] * self.dx
+            y += weights[k] * self.dy
+            scale = STICK_MAX / max(math.hypot(x, y), STICK_MAX)
+            x, y = x * scale, y * scale
+            xs[k], ys[k] = x, y
+            if round(math.atan2(y, x) / ANGLE_RAD) % ANGLE_STEPS == end_step:
+                xs[k:], ys[k:] = x, y
+                if self.final is None:
+                    self.final = n + k
+                break
+
+        self.on_rim = rim < len(weights)
+        self.x, self.y = xs[-1], ys[-1]
+        mags = np.minimum(np.rint(np.hypot(xs, ys)), STICK_MAX)
+        steps = np.rint(np.arctan2(ys, xs) / ANGLE_RAD) % ANGLE_STEPS
+        return mags.astype(np.int64), steps.astype(np.int64)